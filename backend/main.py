@@ -1,6 +1,8 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, status
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.routing import Match
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
@@ -12,9 +14,37 @@ import asyncpg
 from dotenv import load_dotenv
 import paypalrestsdk
 import json
+import time
+import asyncio
+import bisect
+import gzip
+import fcntl
+import hashlib
+import hmac
+import logging
+import math
+import mmap
+import heapq
+from urllib.parse import quote
+from array import array
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+import random
+import shutil
+import sys
+import threading
+import numpy as np
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
 
 load_dotenv()  
 
+logger = logging.getLogger(__name__)
+
 # PayPal Configuration
 paypal_client_id = os.getenv("PAYPAL_CLIENT_ID")
 paypal_client_secret = os.getenv("PAYPAL_CLIENT_SECRET")
@@ -30,20 +60,750 @@ if paypal_client_id and paypal_client_secret:
 # Database setup
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# asyncpg caches prepared statements per connection keyed by query text; pooled
+# connections keep that cache alive across requests, including the finite set
+# of UPDATE statements produced by the dynamic builders
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+DB_POOL_ACQUIRE_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT_SECONDS", "10"))
+
+# Hot queries shared by their handlers and the startup warmup; the statement
+# cache matches on exact query text, so both must use these constants
+PRODUCT_BY_ID_QUERY = "SELECT * FROM products WHERE id = $1 AND is_active = true"
+PRODUCTS_BY_IDS_QUERY = "SELECT * FROM products WHERE id = ANY($1) AND is_active = true"
+USER_BY_EMAIL_AND_ID_QUERY = "SELECT * FROM users WHERE email = $1 AND id = $2"
+CART_ITEMS_QUERY = """
+    SELECT ci.*, p.name, p.price, p.image_url
+    FROM cart_items ci
+    JOIN products p ON ci.product_id = p.id
+    WHERE ci.user_id = $1
+"""
+
+db_pool = None
+db_pool_lock = None
+
 async def get_db_connection():
     return await asyncpg.connect(DATABASE_URL)
 
-async def sql(query: str, params: list = None):
-    conn = await get_db_connection()
-    try:
+async def get_db_pool():
+    global db_pool, db_pool_lock
+    if db_pool is None:
+        # Created lazily so it binds to the running event loop
+        if db_pool_lock is None:
+            db_pool_lock = asyncio.Lock()
+        async with db_pool_lock:
+            if db_pool is None:
+                db_pool = await asyncpg.create_pool(
+                    DATABASE_URL,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                )
+    return db_pool
+
+async def acquire_connection(pool):
+    with profile_span("db.acquire"):
+        try:
+            return await pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="Database is busy, please retry")
+
+async def fetch_dicts(conn, query: str, params: list = None):
+    with profile_span("db.fetch"):
         if params:
             result = await conn.fetch(query, *params)
         else:
             result = await conn.fetch(query)
+    with profile_span("db.to_dict"):
         return [dict(record) for record in result]
+
+async def sql(query: str, params: list = None):
+    pool = await get_db_pool()
+    conn = await acquire_connection(pool)
+    try:
+        return await fetch_dicts(conn, query, params)
+    finally:
+        await pool.release(conn)
+
+@asynccontextmanager
+async def advisory_lock(lock_id: int):
+    # Session-level pg_try_advisory_lock held on its own connection outside the
+    # pool, so the locked section can still use sql() with a pool of one (serve.py
+    # budgets one per lock user in DEDICATED_CONNECTIONS_PER_WORKER); yields
+    # whether this process got it. Closing the session unlocks it even if we are
+    # cancelled before the explicit unlock.
+    conn = await get_db_connection()
+    try:
+        acquired = await conn.fetchval("SELECT pg_try_advisory_lock($1)", lock_id)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                await conn.fetchval("SELECT pg_advisory_unlock($1)", lock_id)
     finally:
         await conn.close()
 
+# Build outputs shared between processes (recommendation and suggest indexes) are
+# written to base_dir/generations/<generation>, never in place, and base_dir/current
+# is swapped atomically to point at the newest one
+def read_generation_pointer(base_dir: str):
+    # "<generation> <built_at>", or None before the first build
+    try:
+        with open(os.path.join(base_dir, "current")) as f:
+            generation, built_at = f.read().split()
+    except (OSError, ValueError):
+        return None
+    return int(generation), float(built_at)
+
+def write_generation_pointer(base_dir: str, generation: int, keep_generations: int):
+    tmp_pointer = os.path.join(base_dir, f"current.{os.getpid()}.tmp")
+    with open(tmp_pointer, "w") as f:
+        f.write(f"{generation} {time.time()}")
+    os.replace(tmp_pointer, os.path.join(base_dir, "current"))
+    
+    # Other processes may still be mapping the previous generations, keep a few
+    generations_dir = os.path.join(base_dir, "generations")
+    for name in sorted(os.listdir(generations_dir), key=int)[:-keep_generations]:
+        shutil.rmtree(os.path.join(generations_dir, name), ignore_errors=True)
+
+def try_lock_host_build(base_dir: str):
+    # Non-blocking flock shared by the processes of this host; returns the open
+    # file while held, None otherwise. Closing it releases the lock.
+    os.makedirs(base_dir, exist_ok=True)
+    lock_file = open(os.path.join(base_dir, "build.lock"), "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+class UnitOfWork:
+    # One pooled connection leased for the whole request; FastAPI only releases
+    # it after the response is sent, so handlers holding one must not call sql().
+    # Mutating handlers run their check, dependent write and notify_invalidation()
+    # inside uow.transaction() and apply the invalidation locally after commit.
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def fetch(self, query: str, params: list = None):
+        return await fetch_dicts(self.conn, query, params)
+
+    async def executemany(self, query: str, args: list):
+        # Pipelined: one round trip for the whole batch
+        with profile_span("db.fetch"):
+            await self.conn.executemany(query, args)
+
+    def transaction(self):
+        return self.conn.transaction()
+
+async def get_unit_of_work():
+    pool = await get_db_pool()
+    conn = await acquire_connection(pool)
+    try:
+        yield UnitOfWork(conn)
+    finally:
+        await pool.release(conn)
+
+# Background tasks
+# The event loop only keeps weak references to tasks, so long-running ones are
+# held here until they finish and cancelled on shutdown.
+background_tasks = set()
+
+def spawn_background_task(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def cancel_background_tasks():
+    tasks = list(background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# Cache invalidation bus
+# Write paths publish compact "entity:id:version:sent_ms" messages over Postgres
+# NOTIFY. The version is the writing transaction's txid_current() and sent_ms is
+# the database clock, so both are comparable across hosts. Each process keeps one
+# LISTEN connection and applies every message to its local caches. Messages
+# arrive in commit order, but a txid is assigned at a transaction's first write,
+# so a lower one can arrive later; dropping a key is idempotent, so nothing is
+# skipped for being older. After a reconnect every local cache is flushed since
+# messages may have been missed. A new process starts with
+# empty caches, so its first connect does not flush (which would also re-trigger
+# the snapshot and suggest rebuilds on every worker start).
+INVALIDATION_CHANNEL = "cache_invalidation"
+# Events that carry data rather than name a cache key go over a second channel
+# as JSON; the sending transaction's txid is added as "txid"
+BROADCAST_CHANNEL = "app_broadcast"
+BROADCAST_NOTIFY_QUERY = "SELECT pg_notify($1, jsonb_set($2::jsonb, '{txid}', to_jsonb(txid_current()))::text)"
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+BROADCAST_MAX_PAYLOAD_BYTES = 7900
+INVALIDATION_RECONNECT_SECONDS = 1.0
+INVALIDATION_STARTUP_WAIT_SECONDS = 5.0
+INVALIDATION_LAG_SAMPLES = 1000
+INVALIDATION_VERSION_LIMIT = 100000
+INVALIDATION_NOTIFY_QUERY = """
+    SELECT txid_current() AS version,
+           pg_notify($1, $2 || ':' || txid_current() || ':' ||
+                     (extract(epoch FROM clock_timestamp()) * 1000)::bigint)
+"""
+
+invalidation_handlers = {}
+flush_handlers = []
+broadcast_handlers = {}
+# (entity, id) -> (highest txid seen, invalidation_sequence when last applied),
+# least recently invalidated first. The txid tells whether a build that read
+# with a given snapshot xmin can have missed a change; cache fills are checked
+# against the sequence number, which moves on every message.
+invalidation_versions = OrderedDict()
+invalidation_sequence = 0
+# Bumped on every flush and whenever a version is evicted, so cache fills that
+# started before either are refused
+invalidation_generation = 0
+invalidation_stats = {
+    "received": 0,
+    "applied": 0,
+    "applied_out_of_order": 0,
+    "flushes": 0,
+    "reconnects": 0,
+}
+invalidation_lags = deque(maxlen=INVALIDATION_LAG_SAMPLES)
+
+def on_invalidate(entity: str):
+    def register(handler):
+        invalidation_handlers.setdefault(entity, []).append(handler)
+        return handler
+    return register
+
+def on_flush(handler):
+    flush_handlers.append(handler)
+    return handler
+
+def on_broadcast(kind: str):
+    def register(handler):
+        broadcast_handlers.setdefault(kind, []).append(handler)
+        return handler
+    return register
+
+def invalidation_token(entity: str, entity_id):
+    # Taken before a cache fill reads the database; the fill is only stored if
+    # the token is unchanged afterwards (see TTLCache.put)
+    return (invalidation_generation, invalidation_versions.get((entity, entity_id), (0, 0))[1])
+
+def invalidation_txid(entity: str, entity_id, default: int = 0) -> int:
+    # Highest txid invalidated for the key, or default if none is remembered
+    entry = invalidation_versions.get((entity, entity_id))
+    return default if entry is None else entry[0]
+
+def apply_invalidation(entity: str, entity_id: int, version: int) -> bool:
+    # Returns False only for the echo of a message already applied locally
+    global invalidation_generation, invalidation_sequence
+    key = (entity, entity_id)
+    txid = invalidation_txid(entity, entity_id)
+    if version == txid:
+        return False
+    if version < txid:
+        invalidation_stats["applied_out_of_order"] += 1
+    invalidation_sequence += 1
+    invalidation_versions[key] = (max(txid, version), invalidation_sequence)
+    invalidation_versions.move_to_end(key)
+    if len(invalidation_versions) > INVALIDATION_VERSION_LIMIT:
+        invalidation_versions.popitem(last=False)
+        invalidation_generation += 1
+    for handler in invalidation_handlers.get(entity, []):
+        try:
+            handler(entity_id)
+        except Exception:
+            logger.exception("Invalidation handler failed for %s:%s", entity, entity_id)
+    invalidation_stats["applied"] += 1
+    return True
+
+def flush_local_caches():
+    global invalidation_generation
+    invalidation_generation += 1
+    for handler in flush_handlers:
+        try:
+            handler()
+        except Exception:
+            logger.exception("Cache flush handler failed")
+    invalidation_stats["flushes"] += 1
+
+async def notify_invalidation(uow, entity: str, entity_id: int) -> int:
+    # Must run inside uow.transaction(): NOTIFY is only delivered on commit. The
+    # caller applies the returned version locally once the transaction commits.
+    result = await uow.fetch(INVALIDATION_NOTIFY_QUERY, [INVALIDATION_CHANNEL, f"{entity}:{entity_id}"])
+    return result[0]["version"]
+
+async def publish_invalidation(entity: str, entity_id: int) -> Optional[int]:
+    # For publishers that are not inside a request's unit of work; returns the
+    # version, or None if the message could not be sent
+    try:
+        result = await sql(INVALIDATION_NOTIFY_QUERY, [INVALIDATION_CHANNEL, f"{entity}:{entity_id}"])
+    except Exception:
+        # Other instances fall back to their cache TTLs
+        logger.exception("Failed to publish invalidation for %s:%s", entity, entity_id)
+        return None
+    # Our own NOTIFY echo is then recognised by its txid and skipped
+    version = result[0]["version"]
+    apply_invalidation(entity, entity_id, version)
+    return version
+
+def broadcast_payload(kind: str, message: dict) -> Optional[str]:
+    payload = json.dumps({**message, "kind": kind}, separators=(",", ":"))
+    if len(payload.encode("utf-8")) > BROADCAST_MAX_PAYLOAD_BYTES:
+        logger.warning("Dropping %s broadcast of %s bytes", kind, len(payload))
+        return None
+    return payload
+
+async def notify_broadcast(uow, kind: str, message: dict):
+    # Must run inside uow.transaction(): every process, this one included,
+    # receives it through its listener once the transaction commits
+    payload = broadcast_payload(kind, message)
+    if payload is not None:
+        await uow.fetch(BROADCAST_NOTIFY_QUERY, [BROADCAST_CHANNEL, payload])
+
+async def publish_broadcast(kind: str, message: dict) -> bool:
+    payload = broadcast_payload(kind, message)
+    if payload is None:
+        return False
+    try:
+        await sql(BROADCAST_NOTIFY_QUERY, [BROADCAST_CHANNEL, payload])
+    except Exception:
+        logger.exception("Failed to publish %s broadcast", kind)
+        return False
+    return True
+
+def handle_broadcast_message(connection, pid, channel, payload):
+    try:
+        message = json.loads(payload)
+        kind = message["kind"]
+    except (ValueError, KeyError, TypeError):
+        logger.warning("Ignoring malformed broadcast %r", payload)
+        return
+    for handler in broadcast_handlers.get(kind, []):
+        try:
+            handler(message)
+        except Exception:
+            logger.exception("Broadcast handler failed for %s", kind)
+
+def handle_invalidation_message(connection, pid, channel, payload):
+    try:
+        entity, entity_id, version, sent_ms = payload.rsplit(":", 3)
+        entity_id, version, sent_ms = int(entity_id), int(version), int(sent_ms)
+    except ValueError:
+        logger.warning("Ignoring malformed invalidation message %r", payload)
+        return
+    invalidation_stats["received"] += 1
+    if apply_invalidation(entity, entity_id, version):
+        invalidation_lags.append(max(0.0, time.time() * 1000 - sent_ms))
+
+async def invalidation_listener(listening: asyncio.Event):
+    global invalidation_generation
+    while True:
+        conn = None
+        try:
+            conn = await get_db_connection()
+            terminated = asyncio.Event()
+            conn.add_termination_listener(lambda _: terminated.set())
+            await conn.add_listener(INVALIDATION_CHANNEL, handle_invalidation_message)
+            await conn.add_listener(BROADCAST_CHANNEL, handle_broadcast_message)
+            if listening.is_set():
+                # Anything published while we were not listening is lost
+                flush_local_caches()
+            else:
+                # Nothing is cached yet; only refuse fills that started before now
+                invalidation_generation += 1
+                listening.set()
+            await terminated.wait()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Invalidation listener connection failed")
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        invalidation_stats["reconnects"] += 1
+        await asyncio.sleep(INVALIDATION_RECONNECT_SECONDS)
+
+def invalidation_lag_summary():
+    lags = sorted(invalidation_lags)
+    if not lags:
+        return {"samples": 0}
+    return {
+        "samples": len(lags),
+        "last_ms": round(invalidation_lags[-1], 3),
+        "mean_ms": round(sum(lags) / len(lags), 3),
+        "p50_ms": round(lags[len(lags) // 2], 3),
+        "p99_ms": round(lags[min(len(lags) - 1, int(len(lags) * 0.99))], 3),
+        "max_ms": round(lags[-1], 3),
+    }
+
+# Local caches
+class TTLCache:
+    # Entries keep the invalidation token taken before their value was read; a
+    # fill that raced an invalidation is refused, and an entry older than the
+    # last invalidation for its key is never served. Holds at most max_entries,
+    # evicting the least recently used.
+    def __init__(self, entity: str, ttl_seconds: int, max_entries: int):
+        self.entity = entity
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def token(self, key):
+        return invalidation_token(self.entity, key)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, (_, sequence), value = entry
+        if expires_at < time.monotonic() or sequence < self.token(key)[1]:
+            self.entries.pop(key, None)
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, token) -> bool:
+        if token != self.token(key):
+            return False
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, token, value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return True
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+PRODUCT_CACHE_TTL_SECONDS = int(os.getenv("PRODUCT_CACHE_TTL_SECONDS", "60"))
+PRINCIPAL_CACHE_TTL_SECONDS = int(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "30"))
+PRODUCT_CACHE_MAX_ENTRIES = int(os.getenv("PRODUCT_CACHE_MAX_ENTRIES", "10000"))
+PRINCIPAL_CACHE_MAX_ENTRIES = int(os.getenv("PRINCIPAL_CACHE_MAX_ENTRIES", "10000"))
+product_cache = TTLCache("product", PRODUCT_CACHE_TTL_SECONDS, PRODUCT_CACHE_MAX_ENTRIES)
+principal_cache = TTLCache("user", PRINCIPAL_CACHE_TTL_SECONDS, PRINCIPAL_CACHE_MAX_ENTRIES)
+
+on_invalidate("product")(product_cache.invalidate)
+on_invalidate("user")(principal_cache.invalidate)
+on_flush(product_cache.clear)
+on_flush(principal_cache.clear)
+
+# Sampling profiler
+# Off unless PROFILE_SAMPLE_RATE > 0 or a request carries X-Debug-Profile with
+# PROFILE_DEBUG_TOKEN. While a profiled request is in flight a background thread
+# samples the event loop thread's stack every PROFILE_INTERVAL_MS and attributes
+# it to the running task's route, building folded (flamegraph-compatible) stacks.
+# profile_span() records time spent awaiting the database and in blocking calls
+# (bcrypt, JWT, PayPal) for the same request.
+#
+# Each worker periodically writes its aggregates to its own file in PROFILE_DIR,
+# and the admin endpoints merge every file with the serving worker's live data.
+# Sample rate changes go out on the broadcast channel with the rate in the
+# payload, and every worker also saves them to PROFILE_SETTINGS_FILE for workers
+# that start later or missed the message; resets go over the invalidation bus.
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DEBUG_TOKEN = os.getenv("PROFILE_DEBUG_TOKEN")
+PROFILE_DEBUG_HEADER = "x-debug-profile"
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_STACKS_PER_ROUTE = 5000
+PROFILE_MAX_STACK_DEPTH = 128
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/estore-profiles")
+PROFILE_SETTINGS_FILE = os.path.join(PROFILE_DIR, "settings.json")
+PROFILE_SETTINGS_LOCK_ID = 7271005
+PROFILE_FLUSH_SECONDS = float(os.getenv("PROFILE_FLUSH_SECONDS", "10"))
+# The start time keeps a recycled worker that reuses a pid from overwriting
+# its predecessor's data
+PROFILE_WORKER_FILE = f"worker-{os.getpid()}-{time.time_ns()}.json"
+
+class RequestProfile:
+    __slots__ = ("started_at", "spans")
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.spans = {}
+
+class RouteProfile:
+    def __init__(self):
+        self.requests = 0
+        self.samples = 0
+        self.wall_ms = 0.0
+        self.spans_ms = {}
+        self.stacks = Counter()
+
+    def summary(self):
+        spans_total = sum(self.spans_ms.values())
+        return {
+            "requests": self.requests,
+            "samples": self.samples,
+            "wall_ms": round(self.wall_ms, 3),
+            "mean_ms": round(self.wall_ms / self.requests, 3) if self.requests else 0,
+            "spans_ms": {name: round(ms, 3) for name, ms in self.spans_ms.items()},
+            "other_ms": round(max(0.0, self.wall_ms - spans_total), 3),
+        }
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "samples": self.samples,
+            "wall_ms": self.wall_ms,
+            "spans_ms": dict(self.spans_ms),
+            "stacks": dict(self.stacks),
+        }
+
+    def merge(self, data: dict):
+        self.requests += data["requests"]
+        self.samples += data["samples"]
+        self.wall_ms += data["wall_ms"]
+        for name, ms in data["spans_ms"].items():
+            self.spans_ms[name] = self.spans_ms.get(name, 0.0) + ms
+        self.stacks.update(data["stacks"])
+
+current_request_profile = ContextVar("current_request_profile", default=None)
+route_profiles = {}
+# Task currently profiled -> route key, read by the sampler thread
+profiled_tasks = {}
+profiler_lock = threading.Lock()
+profiler_wakeup = threading.Event()
+profiler_thread = None
+profiler_loop = None
+# Bumped whenever route_profiles changes / is reset, both under profiler_lock
+profile_revision = 0
+profile_flushed_revision = 0
+profile_reset_generation = 0
+# Serializes this worker's file writes with its removal on reset
+profile_file_lock = threading.Lock()
+profile_settings_version = 0
+
+@contextmanager
+def profile_span(name: str):
+    profile = current_request_profile.get()
+    if profile is None:
+        yield
+        return
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - started_at) * 1000
+        profile.spans[name] = profile.spans.get(name, 0.0) + elapsed_ms
+
+def fold_stack(frame) -> str:
+    names = []
+    while frame is not None and len(names) < PROFILE_MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+def sample_loop_thread(loop_thread_id: int):
+    global profile_revision
+    interval = PROFILE_INTERVAL_MS / 1000
+    while True:
+        profiler_wakeup.wait()
+        time.sleep(interval)
+        task = asyncio.current_task(profiler_loop)
+        if task is None:
+            continue
+        route = profiled_tasks.get(task)
+        if route is None:
+            continue
+        frame = sys._current_frames().get(loop_thread_id)
+        if frame is None:
+            continue
+        stack = fold_stack(frame)
+        with profiler_lock:
+            profile_revision += 1
+            route_profile = route_profiles.setdefault(route, RouteProfile())
+            route_profile.samples += 1
+            if stack in route_profile.stacks or len(route_profile.stacks) < PROFILE_MAX_STACKS_PER_ROUTE:
+                route_profile.stacks[stack] += 1
+            else:
+                route_profile.stacks["[truncated]"] += 1
+
+def ensure_profiler_thread():
+    global profiler_thread, profiler_loop
+    if profiler_thread is None:
+        profiler_loop = asyncio.get_running_loop()
+        profiler_thread = threading.Thread(
+            target=sample_loop_thread, args=(threading.get_ident(),), name="sampling-profiler", daemon=True
+        )
+        profiler_thread.start()
+        spawn_background_task(profile_flush_loop())
+
+def profile_worker_path() -> str:
+    return os.path.join(PROFILE_DIR, PROFILE_WORKER_FILE)
+
+def write_profile_file(routes: dict, reset_generation: int):
+    with profile_file_lock:
+        if reset_generation != profile_reset_generation:
+            # Captured before a reset; the data is gone
+            return
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        tmp_path = profile_worker_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"pid": os.getpid(), "routes": routes}, f)
+        os.replace(tmp_path, profile_worker_path())
+
+async def flush_profile():
+    global profile_flushed_revision
+    with profiler_lock:
+        if profile_revision == profile_flushed_revision:
+            return
+        revision = profile_revision
+        reset_generation = profile_reset_generation
+        routes = {route: route_profile.to_dict() for route, route_profile in route_profiles.items()}
+    await asyncio.to_thread(write_profile_file, routes, reset_generation)
+    profile_flushed_revision = revision
+
+async def profile_flush_loop():
+    while True:
+        await asyncio.sleep(PROFILE_FLUSH_SECONDS)
+        try:
+            await flush_profile()
+        except OSError:
+            logger.exception("Failed to write profile data to %s", PROFILE_DIR)
+
+def merged_route_profiles():
+    # Every other worker's last flush plus this worker's live data
+    merged = {}
+    workers = 1
+    try:
+        names = os.listdir(PROFILE_DIR)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if not name.startswith("worker-") or not name.endswith(".json") or name == PROFILE_WORKER_FILE:
+            continue
+        try:
+            with open(os.path.join(PROFILE_DIR, name)) as f:
+                routes = json.load(f)["routes"]
+        except (OSError, ValueError, KeyError):
+            # Removed by a concurrent reset
+            continue
+        workers += 1
+        for route, data in routes.items():
+            merged.setdefault(route, RouteProfile()).merge(data)
+    with profiler_lock:
+        for route, route_profile in route_profiles.items():
+            merged.setdefault(route, RouteProfile()).merge(route_profile.to_dict())
+    return merged, workers
+
+def apply_profile_sample_rate(sample_rate: float, version: int) -> bool:
+    global PROFILE_SAMPLE_RATE, profile_settings_version
+    if version <= profile_settings_version:
+        return False
+    PROFILE_SAMPLE_RATE = sample_rate
+    profile_settings_version = version
+    return True
+
+def save_profile_settings(sample_rate: float, version: int):
+    # Keeps the newest version; the flock orders this host's workers, which all
+    # save every change they receive
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(f"{PROFILE_SETTINGS_FILE}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        settings = read_profile_settings()
+        if settings is not None and settings["version"] >= version:
+            return
+        tmp_path = f"{PROFILE_SETTINGS_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"sample_rate": sample_rate, "version": version}, f)
+        os.replace(tmp_path, PROFILE_SETTINGS_FILE)
+
+def read_profile_settings() -> Optional[dict]:
+    try:
+        with open(PROFILE_SETTINGS_FILE) as f:
+            settings = json.load(f)
+        return {"sample_rate": float(settings["sample_rate"]), "version": int(settings["version"])}
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def reload_profile_settings():
+    settings = read_profile_settings()
+    if settings is not None:
+        apply_profile_sample_rate(settings["sample_rate"], settings["version"])
+
+@on_broadcast("profile_settings")
+def update_profile_settings(message: dict):
+    # txid is the version: updates hold PROFILE_SETTINGS_LOCK_ID before taking
+    # one, so they are numbered in commit order
+    if apply_profile_sample_rate(message["sample_rate"], message["txid"]):
+        try:
+            save_profile_settings(message["sample_rate"], message["txid"])
+        except OSError:
+            logger.exception("Failed to save profiling settings to %s", PROFILE_SETTINGS_FILE)
+
+@on_flush
+def reload_profile_settings_after_flush():
+    # A change broadcast while this worker was disconnected was still saved by
+    # the worker that served it, and by any other worker on this host
+    reload_profile_settings()
+
+@on_invalidate("profile_reset")
+def reset_profile_data(_):
+    global profile_reset_generation
+    with profiler_lock:
+        route_profiles.clear()
+        profile_reset_generation += 1
+    with profile_file_lock:
+        try:
+            os.remove(profile_worker_path())
+        except FileNotFoundError:
+            pass
+
+def route_key(app, scope) -> str:
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return f"{scope['method']} {route.path}"
+    return f"{scope['method']} [unmatched]"
+
+class SamplingProfilerMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    def should_profile(self, scope) -> bool:
+        if PROFILE_DEBUG_TOKEN:
+            for name, value in scope.get("headers", []):
+                if name == PROFILE_DEBUG_HEADER.encode() and hmac.compare_digest(value, PROFILE_DEBUG_TOKEN.encode()):
+                    return True
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        global profile_revision
+        if scope["type"] != "http" or not self.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+        
+        ensure_profiler_thread()
+        profile = RequestProfile()
+        token = current_request_profile.set(profile)
+        task = asyncio.current_task()
+        route = route_key(app, scope)
+        profiled_tasks[task] = route
+        profiler_wakeup.set()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            del profiled_tasks[task]
+            if not profiled_tasks:
+                profiler_wakeup.clear()
+            current_request_profile.reset(token)
+            wall_ms = (time.perf_counter() - profile.started_at) * 1000
+            with profiler_lock:
+                profile_revision += 1
+                route_profile = route_profiles.setdefault(route, RouteProfile())
+                route_profile.requests += 1
+                route_profile.wall_ms += wall_ms
+                for name, ms in profile.spans.items():
+                    route_profile.spans_ms[name] = route_profile.spans_ms.get(name, 0.0) + ms
+
 # Security
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-here-change-in-production")
 ALGORITHM = "HS256"
@@ -71,6 +831,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(SamplingProfilerMiddleware)
+
 # Add explicit OPTIONS handler for preflight requests
 @app.options("/{path:path}")
 async def options_handler(path: str):
@@ -99,6 +861,30 @@ async def health_check():
             "timestamp": datetime.utcnow().isoformat()
         }
 
+@app.on_event("startup")
+async def start_invalidation_listener():
+    if not DATABASE_URL:
+        return
+    listening = asyncio.Event()
+    spawn_background_task(invalidation_listener(listening))
+    # Keep local caches from filling before invalidations can reach them
+    try:
+        await asyncio.wait_for(listening.wait(), INVALIDATION_STARTUP_WAIT_SECONDS)
+    except asyncio.TimeoutError:
+        logger.warning("Invalidation listener not connected after %ss, starting anyway",
+                       INVALIDATION_STARTUP_WAIT_SECONDS)
+
+@app.on_event("shutdown")
+async def close_db_pool():
+    # Stop the listener and background jobs before their connections go away
+    await cancel_background_tasks()
+    if db_pool is not None:
+        await db_pool.close()
+
+@app.get("/health/invalidation")
+async def invalidation_health():
+    return {**invalidation_stats, "lag": invalidation_lag_summary()}
+
 # Enums
 class UserRole(str, Enum):
     CUSTOMER = "customer"
@@ -137,6 +923,10 @@ class ProductUpdate(BaseModel):
     category: Optional[str] = None
     image_url: Optional[str] = None
 
+class ProductBatchRequest(BaseModel):
+    ids: List[int]
+    fields: Optional[List[str]] = None
+
 class CartItemCreate(BaseModel):
     product_id: int
     quantity: int
@@ -160,10 +950,12 @@ class PasswordUpdate(BaseModel):
 
 # Auth utilities
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    with profile_span("bcrypt"):
+        return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    with profile_span("bcrypt"):
+        return pwd_context.hash(password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -189,7 +981,8 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        with profile_span("jwt"):
+            payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
         user_id: int = payload.get("user_id")
         if email is None or user_id is None:
@@ -197,30 +990,44 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except JWTError:
         raise credentials_exception
     
-    user = await sql("SELECT * FROM users WHERE email = $1 AND id = $2", [email, user_id])
+    cached = principal_cache.get(user_id)
+    if cached is not None and cached["email"] == email:
+        return cached
+    
+    token = principal_cache.token(user_id)
+    user = await sql(USER_BY_EMAIL_AND_ID_QUERY, [email, user_id])
     if not user:
         raise credentials_exception
+    principal_cache.put(user_id, user[0], token)
     return user[0]
 
 # Auth endpoints
+SIGNUP_LOCK_ID = 7271003
+
 @app.post("/auth/signup", response_model=dict)
-async def signup(user: UserCreate):
-    # Check if user exists
-    existing_user = await sql("SELECT id FROM users WHERE email = $1", [user.email])
-    if existing_user:
-        raise HTTPException(status_code=400, detail="Email already registered")
-    
-    # Check if username exists
-    existing_username = await sql("SELECT id FROM users WHERE username = $1", [user.username])
-    if existing_username:
-        raise HTTPException(status_code=400, detail="Username already taken")
-    
-    # Hash password and create user
+async def signup(user: UserCreate, uow: UnitOfWork = Depends(get_unit_of_work)):
+    # Hashed before the transaction so the signup lock is only held briefly
     hashed_password = get_password_hash(user.password)
-    result = await sql(
-        "INSERT INTO users (email, username, hashed_password, role) VALUES ($1, $2, $3, $4) RETURNING id",
-        [user.email, user.username, hashed_password, user.role]
-    )
+    
+    async with uow.transaction():
+        # The checks below cannot lock rows that do not exist yet, so concurrent
+        # signups are serialized until commit
+        await uow.fetch("SELECT pg_advisory_xact_lock($1)", [SIGNUP_LOCK_ID])
+        
+        # Check if user exists
+        existing_user = await uow.fetch("SELECT id FROM users WHERE email = $1", [user.email])
+        if existing_user:
+            raise HTTPException(status_code=400, detail="Email already registered")
+        
+        # Check if username exists
+        existing_username = await uow.fetch("SELECT id FROM users WHERE username = $1", [user.username])
+        if existing_username:
+            raise HTTPException(status_code=400, detail="Username already taken")
+        
+        result = await uow.fetch(
+            "INSERT INTO users (email, username, hashed_password, role) VALUES ($1, $2, $3, $4) RETURNING id",
+            [user.email, user.username, hashed_password, user.role]
+        )
     
     return {"message": "User created successfully", "user_id": result[0]["id"]}
 
@@ -257,7 +1064,7 @@ async def refresh_token(refresh_token: str):
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid refresh token")
     
-    user = await sql("SELECT * FROM users WHERE email = $1 AND id = $2", [email, user_id])
+    user = await sql(USER_BY_EMAIL_AND_ID_QUERY, [email, user_id])
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
     
@@ -285,40 +1092,45 @@ async def get_current_user_info(current_user: dict = Depends(get_current_user)):
 @app.put("/auth/profile")
 async def update_profile(
     user_update: UserUpdate,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    uow: UnitOfWork = Depends(get_unit_of_work)
 ):
     update_fields = []
     params = []
     param_count = 1
     
-    for field, value in user_update.dict(exclude_unset=True).items():
-        if field == "email":
-            # Check if email already exists
-            existing_email = await sql("SELECT id FROM users WHERE email = $1 AND id != $2", [value, current_user["id"]])
-            if existing_email:
-                raise HTTPException(status_code=400, detail="Email already registered")
-        elif field == "username":
-            # Check if username already exists
-            existing_username = await sql("SELECT id FROM users WHERE username = $1 AND id != $2", [value, current_user["id"]])
-            if existing_username:
-                raise HTTPException(status_code=400, detail="Username already taken")
-        
-        update_fields.append(f"{field} = ${param_count}")
-        params.append(value)
-        param_count += 1
-    
-    if not update_fields:
-        return {
-            "id": current_user["id"],
-            "email": current_user["email"],
-            "username": current_user["username"],
-            "role": current_user["role"]
-        }
-    
-    query = f"UPDATE users SET {', '.join(update_fields)} WHERE id = ${param_count} RETURNING *"
-    params.append(current_user["id"])
+    async with uow.transaction():
+        for field, value in user_update.dict(exclude_unset=True).items():
+            if field == "email":
+                # Check if email already exists
+                existing_email = await uow.fetch("SELECT id FROM users WHERE email = $1 AND id != $2", [value, current_user["id"]])
+                if existing_email:
+                    raise HTTPException(status_code=400, detail="Email already registered")
+            elif field == "username":
+                # Check if username already exists
+                existing_username = await uow.fetch("SELECT id FROM users WHERE username = $1 AND id != $2", [value, current_user["id"]])
+                if existing_username:
+                    raise HTTPException(status_code=400, detail="Username already taken")
+            
+            update_fields.append(f"{field} = ${param_count}")
+            params.append(value)
+            param_count += 1
+        
+        if not update_fields:
+            return {
+                "id": current_user["id"],
+                "email": current_user["email"],
+                "username": current_user["username"],
+                "role": current_user["role"]
+            }
+        
+        query = f"UPDATE users SET {', '.join(update_fields)} WHERE id = ${param_count} RETURNING *"
+        params.append(current_user["id"])
+        
+        result = await uow.fetch(query, params)
+        version = await notify_invalidation(uow, "user", current_user["id"])
     
-    result = await sql(query, params)
+    apply_invalidation("user", current_user["id"], version)
     return {
         "id": result[0]["id"],
         "email": result[0]["email"],
@@ -329,7 +1141,8 @@ async def update_profile(
 @app.put("/auth/password")
 async def update_password(
     password_update: PasswordUpdate,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    uow: UnitOfWork = Depends(get_unit_of_work)
 ):
     # Verify current password
     if not verify_password(password_update.current_password, current_user["hashed_password"]):
@@ -338,139 +1151,1361 @@ async def update_password(
     # Hash new password
     new_hashed_password = get_password_hash(password_update.new_password)
     
-    await sql("UPDATE users SET hashed_password = $1 WHERE id = $2", [new_hashed_password, current_user["id"]])
+    async with uow.transaction():
+        await uow.fetch("UPDATE users SET hashed_password = $1 WHERE id = $2", [new_hashed_password, current_user["id"]])
+        version = await notify_invalidation(uow, "user", current_user["id"])
+    apply_invalidation("user", current_user["id"], version)
     
     return {"message": "Password updated successfully"}
 
+# Catalog snapshots
+# Hot listing pages (first page of each category, no search) and product details
+# are rendered to JSON after catalog changes and stored precompressed on disk, so
+# matching requests are served without touching the database. Listings are few
+# and kept in memory; product details are read from disk per request so a large
+# catalog does not sit in every worker's heap.
+#
+# One process at a time publishes (pg_try_advisory_lock). Each publish rewrites
+# the changed products' files under SNAPSHOT_DIR/products (each replaced
+# atomically), renders the listings into an immutable generation directory, then
+# atomically swaps SNAPSHOT_DIR/current and announces the generation on the
+# invalidation bus so the other processes reload it. Every process sees every
+# product invalidation and withdraws that product's snapshot until a generation
+# covering the change is active; one that loses the lock drops its listing
+# snapshots and relies on the holder, which covers the same changes.
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "/tmp/estore-snapshots")
+SNAPSHOT_DEBOUNCE_SECONDS = float(os.getenv("SNAPSHOT_DEBOUNCE_SECONDS", "5"))
+SNAPSHOT_MAX_WAIT_SECONDS = float(os.getenv("SNAPSHOT_MAX_WAIT_SECONDS", "30"))
+SNAPSHOT_MAX_AGE_SECONDS = int(os.getenv("SNAPSHOT_MAX_AGE_SECONDS", "30"))
+SNAPSHOT_PAGE_LIMIT = 20
+SNAPSHOT_KEEP_GENERATIONS = 3
+SNAPSHOT_PUBLISH_LOCK_ID = 7271001
+SNAPSHOT_PUBLISH_BATCH_SIZE = 1000
+# Listings are few and hot, so they get brotli's densest setting; a full publish
+# renders every active product, where quality 11 costs milliseconds per product
+SNAPSHOT_LISTING_BROTLI_QUALITY = 11
+SNAPSHOT_PRODUCT_BROTLI_QUALITY = 5
+ACTIVE_PRODUCTS_AFTER_ID_QUERY = "SELECT * FROM products WHERE is_active = true AND id > $1 ORDER BY id LIMIT $2"
+
+class CatalogSnapshot:
+    __slots__ = ("identity", "gzip", "br", "etag")
+
+    def __init__(self, identity: bytes, gzip_body: bytes, br_body: Optional[bytes], etag: str):
+        self.identity = identity
+        self.gzip = gzip_body
+        self.br = br_body
+        self.etag = etag
+
+    def encode(self) -> bytes:
+        # One file per snapshot so its variants are always replaced together:
+        # "<etag> <identity length> <gzip length> <br length or -1>\n" + bodies
+        br_length = len(self.br) if self.br is not None else -1
+        header = f"{self.etag} {len(self.identity)} {len(self.gzip)} {br_length}\n".encode("utf-8")
+        return header + self.identity + self.gzip + (self.br or b"")
+
+    @classmethod
+    def decode(cls, data: bytes):
+        header_end = data.index(b"\n")
+        etag, identity_length, gzip_length, br_length = data[:header_end].decode("utf-8").split()
+        identity_end = header_end + 1 + int(identity_length)
+        gzip_end = identity_end + int(gzip_length)
+        br_body = data[gzip_end:gzip_end + int(br_length)] if int(br_length) >= 0 else None
+        return cls(data[header_end + 1:identity_end], data[identity_end:gzip_end], br_body, etag)
+
+# Listings of the active generation, and the subset currently served (listings
+# are dropped while a change they do not cover yet is pending)
+catalog_snapshot_generation = None
+catalog_snapshot_entries = {}
+catalog_snapshots = {}
+# Products invalidated since the active generation was published; their files
+# may predate the change
+withdrawn_product_snapshots = set()
+
+snapshot_pending_products = set()
+snapshot_full_pending = False
+snapshot_full_requested_at = 0.0
+snapshot_pending_since = None
+snapshot_last_change = 0.0
+snapshot_publisher_task = None
+
+def listing_snapshot_key(category: Optional[str]):
+    if not category or category == "all":
+        return "products-all"
+    return "products-category-" + quote(category, safe="")
+
+def build_snapshot(payload, brotli_quality: int) -> CatalogSnapshot:
+    identity = json.dumps(jsonable_encoder(payload), separators=(",", ":")).encode("utf-8")
+    etag = '"' + hashlib.sha256(identity).hexdigest()[:32] + '"'
+    gzip_body = gzip.compress(identity, compresslevel=9, mtime=0)
+    br_body = brotli.compress(identity, quality=brotli_quality) if brotli else None
+    return CatalogSnapshot(identity, gzip_body, br_body, etag)
+
+def write_snapshot_file(path: str, snapshot: CatalogSnapshot):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(snapshot.encode())
+    os.replace(tmp_path, path)
+
+def read_snapshot_file(path: str) -> Optional[CatalogSnapshot]:
+    try:
+        with open(path, "rb") as f:
+            return CatalogSnapshot.decode(f.read())
+    except FileNotFoundError:
+        return None
+
+def snapshot_generation_dir(generation: int) -> str:
+    return os.path.join(SNAPSHOT_DIR, "generations", str(generation))
+
+def product_snapshot_path(product_id: int) -> str:
+    return os.path.join(SNAPSHOT_DIR, "products", f"{product_id}.snap")
+
+def read_snapshot_pointer():
+    # "<generation> <covered xmin> <published_at>", or None before the first publish
+    try:
+        with open(os.path.join(SNAPSHOT_DIR, "current")) as f:
+            generation, xmin, published_at = f.read().split()
+    except (OSError, ValueError):
+        return None
+    return int(generation), int(xmin), float(published_at)
+
+def load_snapshot_generation(generation: int) -> dict:
+    gen_dir = snapshot_generation_dir(generation)
+    return {
+        filename[:-len(".snap")]: read_snapshot_file(os.path.join(gen_dir, filename))
+        for filename in os.listdir(gen_dir)
+        if filename.endswith(".snap")
+    }
+
+def write_product_snapshots(products: List[dict], removed_ids=()):
+    os.makedirs(os.path.join(SNAPSHOT_DIR, "products"), exist_ok=True)
+    for product in products:
+        snapshot = build_snapshot(product, SNAPSHOT_PRODUCT_BROTLI_QUALITY)
+        write_snapshot_file(product_snapshot_path(product["id"]), snapshot)
+    for product_id in removed_ids:
+        try:
+            os.remove(product_snapshot_path(product_id))
+        except FileNotFoundError:
+            pass
+
+def remove_stale_product_snapshots(active_ids: set):
+    with os.scandir(os.path.join(SNAPSHOT_DIR, "products")) as entries:
+        for entry in entries:
+            name, _, suffix = entry.name.partition(".")
+            if suffix == "snap" and name.isdigit() and int(name) not in active_ids:
+                os.remove(entry.path)
+
+def write_snapshot_generation(generation: int, pointer: str, payloads: dict) -> dict:
+    # Render, compress and write the listings, then swap the pointer. Runs in a
+    # worker thread; the directory name is unique so nothing else writes to it.
+    snapshots = {key: build_snapshot(payload, SNAPSHOT_LISTING_BROTLI_QUALITY) for key, payload in payloads.items()}
+    gen_dir = snapshot_generation_dir(generation)
+    os.makedirs(gen_dir)
+    for key, snapshot in snapshots.items():
+        with open(os.path.join(gen_dir, f"{key}.snap"), "wb") as f:
+            f.write(snapshot.encode())
+    
+    tmp_pointer = os.path.join(SNAPSHOT_DIR, f"current.{os.getpid()}.tmp")
+    with open(tmp_pointer, "w") as f:
+        f.write(pointer)
+    os.replace(tmp_pointer, os.path.join(SNAPSHOT_DIR, "current"))
+    
+    # Older generations may still be loading in other processes, keep a few
+    generations_dir = os.path.join(SNAPSHOT_DIR, "generations")
+    for name in sorted(os.listdir(generations_dir), key=int)[:-SNAPSHOT_KEEP_GENERATIONS]:
+        shutil.rmtree(os.path.join(generations_dir, name), ignore_errors=True)
+    return snapshots
+
+def activate_snapshot_generation(generation: int, xmin: int, entries: dict):
+    global catalog_snapshot_generation, catalog_snapshot_entries, catalog_snapshots
+    global withdrawn_product_snapshots
+    catalog_snapshot_generation = generation
+    catalog_snapshot_entries = entries
+    catalog_snapshots = dict(entries)
+    # Everything committed before xmin is covered; changes still waiting to be
+    # published must not be served from the old render
+    withdrawn_product_snapshots = {
+        product_id for product_id in withdrawn_product_snapshots
+        if product_id in snapshot_pending_products
+        or invalidation_txid("product", product_id) >= xmin
+    }
+
+def drop_listing_snapshots():
+    catalog_snapshots.clear()
+
+async def reload_catalog_snapshots(generation: Optional[int] = None):
+    pointer = await asyncio.to_thread(read_snapshot_pointer)
+    if pointer is None or (generation is not None and pointer[0] < generation):
+        # The announced generation is not on this disk; serve listings from the database
+        drop_listing_snapshots()
+        return
+    if pointer[0] == catalog_snapshot_generation:
+        # Restore anything withdrawn locally that the generation already covers
+        activate_snapshot_generation(pointer[0], pointer[1], catalog_snapshot_entries)
+        return
+    try:
+        entries = await asyncio.to_thread(load_snapshot_generation, pointer[0])
+    except (OSError, ValueError):
+        logger.exception("Failed to load catalog snapshot generation %s", pointer[0])
+        drop_listing_snapshots()
+        return
+    activate_snapshot_generation(pointer[0], pointer[1], entries)
+
+async def publish_all_product_snapshots():
+    # Keyset-paginated so the catalog is never held in memory at once; files not
+    # rewritten by this pass belong to inactive or deleted products
+    active_ids = set()
+    last_id = 0
+    while True:
+        products = await sql(ACTIVE_PRODUCTS_AFTER_ID_QUERY, [last_id, SNAPSHOT_PUBLISH_BATCH_SIZE])
+        if not products:
+            break
+        await asyncio.to_thread(write_product_snapshots, products)
+        active_ids.update(product["id"] for product in products)
+        last_id = products[-1]["id"]
+    await asyncio.to_thread(remove_stale_product_snapshots, active_ids)
+
+async def publish_catalog_snapshots(product_ids: set, full: bool, full_requested_at: float):
+    async with advisory_lock(SNAPSHOT_PUBLISH_LOCK_ID) as acquired:
+        if not acquired:
+            drop_listing_snapshots()
+            return
+        
+        pointer = await asyncio.to_thread(read_snapshot_pointer)
+        if pointer is not None:
+            _, covered_xmin, published_at = pointer
+            # Skip what a generation published after these changes already covers
+            product_ids = {
+                product_id for product_id in product_ids
+                if invalidation_txid("product", product_id, covered_xmin) >= covered_xmin
+            }
+            full = full and published_at < full_requested_at
+            if not product_ids and not full:
+                await reload_catalog_snapshots()
+                return
+        else:
+            full = True
+        
+        # Everything committed before xmin is visible to the reads below
+        snapshot_info = await sql("SELECT txid_snapshot_xmin(txid_current_snapshot()) AS xmin")
+        xmin = snapshot_info[0]["xmin"]
+        published_at = time.time()
+        
+        # JSON rendering, compression and disk writes are CPU/IO bound, keep them off the event loop
+        if full:
+            await publish_all_product_snapshots()
+        else:
+            products = await sql(PRODUCTS_BY_IDS_QUERY, [list(product_ids)])
+            removed_ids = product_ids - {product["id"] for product in products}
+            await asyncio.to_thread(write_product_snapshots, products, removed_ids)
+        
+        payloads = {listing_snapshot_key(None): await query_products_page(0, SNAPSHOT_PAGE_LIMIT)}
+        categories = await sql("SELECT DISTINCT category FROM products WHERE is_active = true")
+        for row in categories:
+            category = row["category"]
+            if category:
+                payloads[listing_snapshot_key(category)] = await query_products_page(
+                    0, SNAPSHOT_PAGE_LIMIT, category=category
+                )
+        generation = time.time_ns()
+        snapshots = await asyncio.to_thread(
+            write_snapshot_generation, generation, f"{generation} {xmin} {published_at}", payloads
+        )
+        activate_snapshot_generation(generation, xmin, snapshots)
+    
+    await publish_invalidation("catalog_snapshot", generation)
+
+async def snapshot_publisher():
+    global snapshot_full_pending, snapshot_pending_since, snapshot_last_change
+    while snapshot_pending_since is not None:
+        # Debounce bursts of writes, but never hold changes back past the max wait
+        deadline = min(
+            snapshot_last_change + SNAPSHOT_DEBOUNCE_SECONDS,
+            snapshot_pending_since + SNAPSHOT_MAX_WAIT_SECONDS
+        )
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+            continue
+        
+        product_ids = set(snapshot_pending_products)
+        full, full_requested_at = snapshot_full_pending, snapshot_full_requested_at
+        snapshot_pending_products.clear()
+        snapshot_full_pending = False
+        snapshot_pending_since = None
+        try:
+            await publish_catalog_snapshots(product_ids, full, full_requested_at)
+        except Exception:
+            logger.exception("Catalog snapshot publish failed")
+            drop_listing_snapshots()
+            # Retry after the debounce interval
+            snapshot_pending_products.update(product_ids)
+            snapshot_full_pending = snapshot_full_pending or full
+            snapshot_pending_since = snapshot_last_change = time.monotonic()
+
+def schedule_snapshot_publish(product_id: Optional[int] = None):
+    global snapshot_full_pending, snapshot_full_requested_at
+    global snapshot_pending_since, snapshot_last_change, snapshot_publisher_task
+    if product_id is None:
+        snapshot_full_pending = True
+        snapshot_full_requested_at = time.time()
+    else:
+        # The product's own detail snapshot is stale right away; listings catch up after the debounce
+        snapshot_pending_products.add(product_id)
+        withdrawn_product_snapshots.add(product_id)
+    snapshot_last_change = time.monotonic()
+    if snapshot_pending_since is None:
+        snapshot_pending_since = snapshot_last_change
+    # A running publisher picks the change up on its next pass; it is never cancelled
+    if snapshot_publisher_task is None or snapshot_publisher_task.done():
+        snapshot_publisher_task = spawn_background_task(snapshot_publisher())
+
+on_invalidate("product")(schedule_snapshot_publish)
+
+@on_invalidate("catalog_snapshot")
+def load_announced_snapshot_generation(generation: int):
+    if generation != catalog_snapshot_generation:
+        spawn_background_task(reload_catalog_snapshots(generation))
+
+@on_flush
+def republish_catalog_snapshots():
+    schedule_snapshot_publish()
+
+def snapshot_response(request: Request, snapshot: CatalogSnapshot) -> Response:
+    headers = {
+        "ETag": snapshot.etag,
+        "Cache-Control": f"public, max-age={SNAPSHOT_MAX_AGE_SECONDS}",
+        "Vary": "Accept-Encoding",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and snapshot.etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    
+    accepted = {
+        encoding.split(";")[0].strip().lower()
+        for encoding in request.headers.get("accept-encoding", "").split(",")
+    }
+    if snapshot.br is not None and "br" in accepted:
+        headers["Content-Encoding"] = "br"
+        body = snapshot.br
+    elif "gzip" in accepted:
+        headers["Content-Encoding"] = "gzip"
+        body = snapshot.gzip
+    else:
+        body = snapshot.identity
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.on_event("startup")
+async def load_catalog_snapshots():
+    await reload_catalog_snapshots()
+    if catalog_snapshot_generation is None and DATABASE_URL:
+        schedule_snapshot_publish()
+
 # Product endpoints
-@app.get("/products")
-async def get_products(
+async def query_products_page(
     skip: int = 0,
     limit: int = 20,
     category: Optional[str] = None,
     search: Optional[str] = None,
 ):
-    query = "SELECT * FROM products WHERE is_active = true"
+    where = "is_active = true"
     params = []
     
     if category and category != "all":
-        query += " AND category = $" + str(len(params) + 1)
+        where += " AND category = $" + str(len(params) + 1)
         params.append(category)
     
     if search:
-        query += " AND name ILIKE $" + str(len(params) + 1)
+        where += " AND name ILIKE $" + str(len(params) + 1)
         params.append(f"%{search}%")
     
-    query += " ORDER BY created_at DESC LIMIT $" + str(len(params) + 1) + " OFFSET $" + str(len(params) + 2)
-    params.extend([limit, skip])
+    # The window count is evaluated before LIMIT/OFFSET, so the page and the
+    # total come back in a single round trip
+    query = (
+        f"SELECT *, COUNT(*) OVER() AS total_count FROM products WHERE {where}"
+        " ORDER BY created_at DESC LIMIT $" + str(len(params) + 1) + " OFFSET $" + str(len(params) + 2)
+    )
+    products = await sql(query, params + [limit, skip])
     
-    products = await sql(query, params)
+    if products:
+        total = products[0]["total_count"]
+        for product in products:
+            del product["total_count"]
+    elif skip == 0:
+        total = 0
+    else:
+        # Page past the end: no rows to carry the window count
+        total_result = await sql(f"SELECT COUNT(*) as total FROM products WHERE {where}", params)
+        total = total_result[0]["total"] if total_result else 0
     
-    # Get total count
-    count_query = "SELECT COUNT(*) as total FROM products WHERE is_active = true"
-    count_params = []
+    return {
+        "products": products,
+        "total": total,
+        "skip": skip,
+        "limit": limit
+    }
+
+@app.get("/products")
+async def get_products(
+    request: Request,
+    skip: int = 0,
+    limit: int = 20,
+    category: Optional[str] = None,
+    search: Optional[str] = None,
+):
+    if skip == 0 and limit == SNAPSHOT_PAGE_LIMIT and not search:
+        snapshot = catalog_snapshots.get(listing_snapshot_key(category))
+        if snapshot is not None:
+            return snapshot_response(request, snapshot)
+    return await query_products_page(skip, limit, category, search)
+
+# Multi-get for cart/order rendering
+MAX_BATCH_PRODUCT_IDS = 200
+PRODUCT_FIELDS = {
+    "id", "name", "description", "price", "stock", "category",
+    "image_url", "vendor_id", "is_active", "created_at"
+}
+
+def parse_product_fields(fields: Optional[List[str]]):
+    if not fields:
+        return None
+    selected = [field.strip() for field in fields if field.strip()]
+    unknown = [field for field in selected if field not in PRODUCT_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown product fields: {unknown}")
+    if "id" not in selected:
+        selected.insert(0, "id")
+    return selected
+
+async def get_products_batch(ids: List[int], fields: Optional[List[str]] = None):
+    # Keep first occurrence of each id so the response follows the request order
+    ordered_ids = list(dict.fromkeys(ids))
+    if len(ordered_ids) > MAX_BATCH_PRODUCT_IDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many product ids, maximum is {MAX_BATCH_PRODUCT_IDS}"
+        )
+    selected_fields = parse_product_fields(fields)
     
-    if category and category != "all":
-        count_query += " AND category = $1"
-        count_params.append(category)
+    found = {}
+    to_fetch = []
+    for product_id in ordered_ids:
+        product = product_cache.get(product_id)
+        if product is not None:
+            found[product_id] = product
+        else:
+            to_fetch.append(product_id)
     
-    if search:
-        if count_params:
-            count_query += " AND name ILIKE $2"
+    if to_fetch:
+        tokens = {product_id: product_cache.token(product_id) for product_id in to_fetch}
+        rows = await sql(PRODUCTS_BY_IDS_QUERY, [to_fetch])
+        for row in rows:
+            product_cache.put(row["id"], row, tokens[row["id"]])
+            found[row["id"]] = row
+    
+    products = []
+    missing = []
+    for product_id in ordered_ids:
+        product = found.get(product_id)
+        if product is None:
+            missing.append(product_id)
+        elif selected_fields:
+            products.append({field: product.get(field) for field in selected_fields})
         else:
-            count_query += " AND name ILIKE $1"
-        count_params.append(f"%{search}%")
+            products.append(product)
     
-    total_result = await sql(count_query, count_params)
-    total = total_result[0]["total"] if total_result else 0
+    return {"products": products, "missing": missing}
+
+@app.get("/products/batch")
+async def get_products_batch_by_query(ids: str, fields: Optional[str] = None):
+    try:
+        product_ids = [int(product_id) for product_id in ids.split(",") if product_id.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be a comma-separated list of integers")
+    return await get_products_batch(product_ids, fields.split(",") if fields else None)
+
+@app.post("/products/batch")
+async def get_products_batch_by_body(batch_request: ProductBatchRequest):
+    return await get_products_batch(batch_request.ids, batch_request.fields)
+
+# Search-as-you-type suggestions
+# Product names and categories are lower-cased, UTF-8 encoded and stored back to
+# back in one sorted bytes blob, so a prefix lookup is two binary searches over an
+# offsets array. Vendor writes land in a small overlay that is merged at query
+# time; once it grows past SUGGEST_OVERLAY_LIMIT the index is rebuilt. It is also
+# rebuilt every SUGGEST_REBUILD_SECONDS so popularity follows new orders.
+#
+# Like the recommendation index, one process builds at a time
+# (pg_try_advisory_lock), writes the index to a generation directory under
+# SUGGEST_INDEX_DIR and announces it on the invalidation bus; the other
+# processes memory-map the files instead of each scanning every product. A host
+# that does not share the directory builds the announced generation itself.
+SUGGEST_MAX_RESULTS = 20
+SUGGEST_SCAN_LIMIT = 1024
+SUGGEST_PREWARM_PREFIX_LENGTH = 3
+SUGGEST_OVERLAY_LIMIT = int(os.getenv("SUGGEST_OVERLAY_LIMIT", "1000"))
+SUGGEST_REBUILD_SECONDS = int(os.getenv("SUGGEST_REBUILD_SECONDS", "900"))
+SUGGEST_INDEX_DIR = os.getenv("SUGGEST_INDEX_DIR", "/tmp/estore-suggest")
+SUGGEST_BUILD_LOCK_ID = 7271004
+SUGGEST_KEEP_GENERATIONS = 3
+SUGGEST_RETRY_SECONDS = 5
+SUGGEST_INDEX_ARRAYS = (
+    ("key_offsets", "I"), ("display_offsets", "I"), ("refs", "q"), ("popularity", "f"),
+    ("product_ids", "q"), ("product_popularity", "f")
+)
+
+def suggest_key(text: str) -> bytes:
+    return text.strip().lower().encode("utf-8")
+
+def map_suggest_file(path: str):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class SuggestIndex:
+    # Entry i has key keys[key_offsets[i]:key_offsets[i + 1]] and its display text
+    # at the same position in displays; ref is a product id, or -(j + 1) for
+    # categories[j]. product_ids (sorted) and product_popularity hold the order
+    # counts new overlay entries are ranked with.
+    def __init__(self, keys, displays, key_offsets, display_offsets, refs, popularity, product_ids,
+                 product_popularity, categories: List[str], covered_xmin: int = 0, top_cache: dict = None):
+        self.keys = keys
+        self.displays = displays
+        self.key_offsets = key_offsets
+        self.display_offsets = display_offsets
+        self.refs = refs
+        self.popularity = popularity
+        self.product_ids = product_ids
+        self.product_popularity = product_popularity
+        self.categories = categories
+        # Every transaction below this txid had committed when the build read its rows
+        self.covered_xmin = covered_xmin
+        self.top_cache = top_cache if top_cache is not None else {}
+
+    @classmethod
+    def from_entries(cls, entries, categories: List[str], popularity_by_product: dict, covered_xmin: int = 0):
+        # entries: (key, display, ref, popularity)
+        entries.sort(key=lambda entry: (entry[0], -entry[3]))
+        key_offsets = array("I", [0])
+        display_offsets = array("I", [0])
+        for key, display, _, _ in entries:
+            key_offsets.append(key_offsets[-1] + len(key))
+            display_offsets.append(display_offsets[-1] + len(display.encode("utf-8")))
+        product_ids = array("q", sorted(popularity_by_product))
+        index = cls(
+            b"".join(entry[0] for entry in entries),
+            b"".join(entry[1].encode("utf-8") for entry in entries),
+            key_offsets,
+            display_offsets,
+            array("q", (entry[2] for entry in entries)),
+            array("f", (entry[3] for entry in entries)),
+            product_ids,
+            array("f", (popularity_by_product[product_id] for product_id in product_ids)),
+            categories,
+            covered_xmin
+        )
+        index.prewarm()
+        return index
+
+    def save(self, directory: str):
+        # directory must be new; generations are never written in place
+        os.makedirs(directory)
+        for name in ("keys", "displays"):
+            with open(os.path.join(directory, name), "wb") as f:
+                f.write(getattr(self, name))
+        for name, _ in SUGGEST_INDEX_ARRAYS:
+            with open(os.path.join(directory, name), "wb") as f:
+                getattr(self, name).tofile(f)
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump({
+                "categories": self.categories,
+                "covered_xmin": self.covered_xmin,
+                "top_cache": {prefix.hex(): ranking for prefix, ranking in self.top_cache.items()}
+            }, f)
+
+    @classmethod
+    def load(cls, directory: str):
+        # Memory-mapped so every worker shares the same pages; the prewarmed
+        # rankings are loaded rather than recomputed
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        arrays = [
+            memoryview(map_suggest_file(os.path.join(directory, name))).cast(typecode)
+            for name, typecode in SUGGEST_INDEX_ARRAYS
+        ]
+        return cls(
+            map_suggest_file(os.path.join(directory, "keys")),
+            map_suggest_file(os.path.join(directory, "displays")),
+            *arrays,
+            meta["categories"],
+            meta["covered_xmin"],
+            {bytes.fromhex(prefix): ranking for prefix, ranking in meta["top_cache"].items()}
+        )
+
+    def __len__(self):
+        return len(self.refs)
+
+    def key(self, i: int) -> bytes:
+        return self.keys[self.key_offsets[i]:self.key_offsets[i + 1]]
+
+    def display(self, i: int) -> str:
+        return self.displays[self.display_offsets[i]:self.display_offsets[i + 1]].decode("utf-8")
+
+    def product_popularity_of(self, product_id: int) -> float:
+        i = bisect.bisect_left(self.product_ids, product_id)
+        if i < len(self.product_ids) and self.product_ids[i] == product_id:
+            return self.product_popularity[i]
+        return 0
+
+    def lower_bound(self, target: bytes, lo: int = 0) -> int:
+        hi = len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def prefix_range(self, prefix: bytes):
+        lo = self.lower_bound(prefix)
+        # 0xff never occurs in UTF-8, so this is the first key past the prefix
+        return lo, self.lower_bound(prefix + b"\xff", lo)
+
+    def top(self, prefix: bytes, limit: int):
+        # The limit * 2 most popular entries under prefix
+        lo, hi = self.prefix_range(prefix)
+        if hi - lo <= SUGGEST_SCAN_LIMIT:
+            return heapq.nlargest(limit * 2, range(lo, hi), key=self.popularity.__getitem__)
+        cached = self.top_cache.get(prefix)
+        if cached is None:
+            cached = heapq.nlargest(SUGGEST_MAX_RESULTS * 2, range(lo, hi), key=self.popularity.__getitem__)
+            self.top_cache[prefix] = cached
+        if limit * 2 > len(cached):
+            # Deeper than the cached ranking, only asked for when the overlay
+            # shadows most of it
+            return heapq.nlargest(limit * 2, range(lo, hi), key=self.popularity.__getitem__)
+        return cached[:limit * 2]
+
+    def prewarm(self):
+        # Precompute rankings for the short prefixes whose ranges are too wide to scan per keystroke
+        for length in range(1, SUGGEST_PREWARM_PREFIX_LENGTH + 1):
+            i = 0
+            while i < len(self):
+                prefix = self.key(i)[:length]
+                lo, hi = self.prefix_range(prefix)
+                if hi - lo > SUGGEST_SCAN_LIMIT:
+                    self.top_cache[prefix] = heapq.nlargest(
+                        SUGGEST_MAX_RESULTS * 2, range(lo, hi), key=self.popularity.__getitem__
+                    )
+                i = max(hi, i + 1)
+
+    def memory_bytes(self) -> int:
+        arrays = [getattr(self, name) for name, _ in SUGGEST_INDEX_ARRAYS]
+        return len(self.keys) + len(self.displays) + sum(a.itemsize * len(a) for a in arrays)
+
+def build_suggest_index(products: List[dict], popularity_by_product: dict, covered_xmin: int = 0) -> SuggestIndex:
+    entries = []
+    category_popularity = {}
+    for product in products:
+        popularity = popularity_by_product.get(product["id"], 0)
+        entries.append((suggest_key(product["name"]), product["name"], product["id"], popularity))
+        if product["category"]:
+            category = product["category"]
+            category_popularity[category] = category_popularity.get(category, 0) + popularity
+    categories = list(category_popularity)
+    for i, category in enumerate(categories):
+        entries.append((suggest_key(category), category, -(i + 1), category_popularity[category]))
+    return SuggestIndex.from_entries(entries, categories, popularity_by_product, covered_xmin)
+
+suggest_index = build_suggest_index([], {})
+suggest_generation = None
+# ("product", id) or ("category", name) -> (key, display, popularity), or None when removed
+suggest_overlay = {}
+# Same keys -> highest invalidation txid behind the overlay entry
+suggest_overlay_versions = {}
+suggest_rebuild_task = None
+# time.time_ns() the reads of the next index must start after
+suggest_rebuild_not_before = 0
+
+def suggest_generation_dir(generation: int) -> str:
+    return os.path.join(SUGGEST_INDEX_DIR, "generations", str(generation))
+
+def build_and_save_suggest_index(products: List[dict], popularity_by_product: dict, covered_xmin: int,
+                                 generation: int) -> SuggestIndex:
+    index = build_suggest_index(products, popularity_by_product, covered_xmin)
+    index.save(suggest_generation_dir(generation))
+    write_generation_pointer(SUGGEST_INDEX_DIR, generation, SUGGEST_KEEP_GENERATIONS)
+    return SuggestIndex.load(suggest_generation_dir(generation))
+
+def swap_suggest_index(index: SuggestIndex):
+    global suggest_index
+    suggest_index = index
+    # Overlay entries whose invalidations all committed before the build's
+    # snapshot are in the index; later ones stay in the overlay
+    for ref in list(suggest_overlay):
+        if suggest_overlay_versions.get(ref, 0) < index.covered_xmin:
+            del suggest_overlay[ref]
+            suggest_overlay_versions.pop(ref, None)
+
+async def reload_suggest_index(generation: Optional[int] = None):
+    # generation: the announced one, which must be built here if this host does
+    # not share the builder's SUGGEST_INDEX_DIR
+    global suggest_generation
+    pointer = await asyncio.to_thread(read_generation_pointer, SUGGEST_INDEX_DIR)
+    if generation is not None and (pointer is None or pointer[0] < generation):
+        await build_local_suggest_generation(generation)
+        return
+    if pointer is None or pointer[0] == suggest_generation:
+        return
+    try:
+        index = await asyncio.to_thread(SuggestIndex.load, suggest_generation_dir(pointer[0]))
+    except (OSError, ValueError, KeyError):
+        logger.exception("Failed to load suggest index generation %s", pointer[0])
+        return
+    suggest_generation = pointer[0]
+    swap_suggest_index(index)
+
+async def build_local_suggest_generation(generation: int):
+    # Whoever gets the host lock builds; the others wait and load its result
+    while True:
+        lock_file = await asyncio.to_thread(try_lock_host_build, SUGGEST_INDEX_DIR)
+        if lock_file is not None:
+            break
+        await asyncio.sleep(1)
+    try:
+        pointer = await asyncio.to_thread(read_generation_pointer, SUGGEST_INDEX_DIR)
+        if pointer is None or pointer[0] < generation:
+            await build_suggest_generation(generation)
+            return
+    finally:
+        lock_file.close()
+    await reload_suggest_index()
+
+async def rebuild_suggest_index(not_before: int):
+    # What another process published may already be recent enough
+    await reload_suggest_index()
+    if suggest_generation is not None and suggest_generation >= not_before:
+        return
+    async with advisory_lock(SUGGEST_BUILD_LOCK_ID) as acquired:
+        if acquired:
+            await reload_suggest_index()
+            if suggest_generation is not None and suggest_generation >= not_before:
+                return
+            generation = await build_suggest_generation(time.time_ns())
+    if not acquired:
+        # The builder announces its generation when it is done; until then a host
+        # with no index of its own builds one
+        if suggest_generation is None:
+            await build_local_suggest_generation(time.time_ns())
+        return
+    await publish_invalidation("suggest_index", generation)
+
+async def build_suggest_generation(generation: int) -> int:
+    # generation is a time.time_ns() taken before the reads
+    global suggest_generation
+    pool = await get_db_pool()
+    conn = await acquire_connection(pool)
+    try:
+        async with conn.transaction(isolation="repeatable_read", readonly=True):
+            covered_xmin = await conn.fetchval("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+            products = await fetch_dicts(conn, "SELECT id, name, category FROM products WHERE is_active = true")
+            popularity_rows = await fetch_dicts(conn, """
+                SELECT oi.product_id, SUM(oi.quantity) AS popularity
+                FROM order_items oi
+                JOIN orders o ON oi.order_id = o.id
+                WHERE o.status != ALL($1)
+                GROUP BY oi.product_id
+            """, [RECOMMENDATION_EXCLUDED_STATUSES])
+    finally:
+        await pool.release(conn)
+    popularity_by_product = {row["product_id"]: float(row["popularity"]) for row in popularity_rows}
+    index = await asyncio.to_thread(
+        build_and_save_suggest_index, products, popularity_by_product, covered_xmin, generation
+    )
+    suggest_generation = generation
+    swap_suggest_index(index)
+    return generation
+
+def suggest_rebuild_pending() -> bool:
+    return suggest_generation is None or suggest_generation < suggest_rebuild_not_before
+
+async def run_suggest_rebuild():
+    while suggest_rebuild_pending():
+        try:
+            await rebuild_suggest_index(suggest_rebuild_not_before)
+        except Exception:
+            logger.exception("Suggest index rebuild failed")
+            return
+        if suggest_rebuild_pending():
+            # Another process holds the build lock; its announcement or the
+            # next attempt catches up
+            await asyncio.sleep(SUGGEST_RETRY_SECONDS)
+
+def schedule_suggest_rebuild(not_before: int):
+    global suggest_rebuild_task, suggest_rebuild_not_before
+    suggest_rebuild_not_before = max(suggest_rebuild_not_before, not_before)
+    if suggest_rebuild_task is None or suggest_rebuild_task.done():
+        suggest_rebuild_task = spawn_background_task(run_suggest_rebuild())
+
+async def suggest_rebuild_loop():
+    while True:
+        await asyncio.sleep(SUGGEST_REBUILD_SECONDS)
+        # Any generation from the last half period will do, so only one
+        # process rebuilds per period
+        schedule_suggest_rebuild(time.time_ns() - SUGGEST_REBUILD_SECONDS * 10**9 // 2)
+
+def update_suggest_index(product: dict, txid: int = 0):
+    ref = ("product", product["id"])
+    if product.get("is_active", True):
+        popularity = suggest_index.product_popularity_of(product["id"])
+        suggest_overlay[ref] = (suggest_key(product["name"]), product["name"], popularity)
+    else:
+        suggest_overlay[ref] = None
+    suggest_overlay_versions[ref] = max(suggest_overlay_versions.get(ref, 0), txid)
+    category = product.get("category")
+    if category and category not in suggest_index.categories and ("category", category) not in suggest_overlay:
+        suggest_overlay[("category", category)] = (suggest_key(category), category, 0)
+        suggest_overlay_versions[("category", category)] = txid
+    if len(suggest_overlay) > SUGGEST_OVERLAY_LIMIT:
+        # Any generation newer than the current one folds the overlay in
+        schedule_suggest_rebuild((suggest_generation or 0) + 1)
+
+async def refresh_suggest_entry(product_id: int, txid: int):
+    try:
+        product = await sql("SELECT id, name, category, is_active FROM products WHERE id = $1", [product_id])
+    except Exception:
+        logger.exception("Failed to refresh suggestion for product %s", product_id)
+        return
+    update_suggest_index(product[0] if product else {"id": product_id, "is_active": False}, txid)
+
+@on_invalidate("product")
+def invalidate_suggest_entry(product_id: int):
+    txid = invalidation_txid("product", product_id)
+    spawn_background_task(refresh_suggest_entry(product_id, txid))
+
+@on_invalidate("suggest_index")
+def load_announced_suggest_index(generation: int):
+    if generation != suggest_generation:
+        spawn_background_task(reload_suggest_index(generation))
+
+@on_flush
+def rebuild_suggest_index_after_flush():
+    # Product invalidations may have been missed while disconnected, so only an
+    # index read from now on is complete
+    schedule_suggest_rebuild(time.time_ns())
+
+def get_suggestions(q: str, limit: int):
+    prefix = suggest_key(q)
+    index = suggest_index
+    overlay = suggest_overlay
+    fetch_limit = limit
+    while True:
+        top = index.top(prefix, fetch_limit)
+        candidates = []
+        for i in top:
+            ref = index.refs[i]
+            overlay_ref = ("product", ref) if ref > 0 else ("category", index.categories[-ref - 1])
+            if overlay_ref in overlay:
+                continue
+            candidates.append((index.popularity[i], overlay_ref, index.display(i)))
+        if len(candidates) >= limit or len(top) < fetch_limit * 2:
+            break
+        # The overlay shadows too many of the best entries, look further down
+        fetch_limit *= 4
+    for overlay_ref, entry in overlay.items():
+        if entry is not None and entry[0].startswith(prefix):
+            candidates.append((entry[2], overlay_ref, entry[1]))
     
+    suggestions = []
+    for popularity, (kind, ref), display in heapq.nlargest(limit, candidates, key=lambda c: c[0]):
+        suggestion = {"type": kind, "text": display}
+        if kind == "product":
+            suggestion["product_id"] = ref
+        suggestions.append(suggestion)
+    return suggestions
+
+@app.on_event("startup")
+async def load_suggest_index():
+    if DATABASE_URL:
+        schedule_suggest_rebuild(0)
+        if SUGGEST_REBUILD_SECONDS > 0:
+            spawn_background_task(suggest_rebuild_loop())
+
+@app.get("/products/suggest")
+async def suggest_products(q: str, limit: int = 8):
+    if not q.strip():
+        return {"query": q, "suggestions": []}
+    limit = max(1, min(limit, SUGGEST_MAX_RESULTS))
+    return {"query": q, "suggestions": get_suggestions(q, limit)}
+
+@app.get("/products/suggest/stats")
+async def suggest_index_stats():
+    entries = len(suggest_index)
+    memory_bytes = suggest_index.memory_bytes()
     return {
-        "products": products,
-        "total": total,
-        "skip": skip,
-        "limit": limit
+        "entries": entries,
+        "overlay_entries": len(suggest_overlay),
+        "memory_bytes": memory_bytes,
+        "bytes_per_entry": round(memory_bytes / entries, 1) if entries else 0
     }
 
 @app.get("/products/{product_id}")
-async def get_product(product_id: int):
-    product = await sql("SELECT * FROM products WHERE id = $1 AND is_active = true", [product_id])
+async def get_product(product_id: int, request: Request):
+    if catalog_snapshot_generation is not None and product_id not in withdrawn_product_snapshots:
+        snapshot = await asyncio.to_thread(read_snapshot_file, product_snapshot_path(product_id))
+        if snapshot is not None:
+            return snapshot_response(request, snapshot)
+    cached = product_cache.get(product_id)
+    if cached is not None:
+        return cached
+    token = product_cache.token(product_id)
+    product = await sql(PRODUCT_BY_ID_QUERY, [product_id])
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
+    product_cache.put(product_id, product[0], token)
     return product[0]
 
 @app.post("/vendor/products")
 async def create_product(
     product: ProductCreate,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    uow: UnitOfWork = Depends(get_unit_of_work)
 ):
     if current_user["role"] not in [UserRole.VENDOR, UserRole.ADMIN]:
         raise HTTPException(status_code=403, detail="Not authorized to create products")
     
-    result = await sql(
-        """INSERT INTO products (name, description, price, stock, category, image_url, vendor_id) 
-           VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING *""",
-        [product.name, product.description, product.price, product.stock, 
-         product.category, product.image_url, current_user["id"]]
-    )
+    async with uow.transaction():
+        result = await uow.fetch(
+            """INSERT INTO products (name, description, price, stock, category, image_url, vendor_id) 
+               VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING *""",
+            [product.name, product.description, product.price, product.stock, 
+             product.category, product.image_url, current_user["id"]]
+        )
+        version = await notify_invalidation(uow, "product", result[0]["id"])
+    
+    apply_invalidation("product", result[0]["id"], version)
     return result[0]
 
 @app.put("/vendor/products/{product_id}")
 async def update_product(
     product_id: int,
     product_update: ProductUpdate,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    uow: UnitOfWork = Depends(get_unit_of_work)
 ):
-    # Check if product exists and belongs to user
-    product = await sql("SELECT * FROM products WHERE id = $1", [product_id])
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    
-    if product[0]["vendor_id"] != current_user["id"] and current_user["role"] != UserRole.ADMIN:
-        raise HTTPException(status_code=403, detail="Not authorized to update this product")
-    
-    # Build update query dynamically
-    update_fields = []
-    params = []
-    param_count = 1
-    
-    for field, value in product_update.dict(exclude_unset=True).items():
-        update_fields.append(f"{field} = ${param_count}")
-        params.append(value)
-        param_count += 1
-    
-    if not update_fields:
-        return product[0]
-    
-    query = f"UPDATE products SET {', '.join(update_fields)} WHERE id = ${param_count} RETURNING *"
-    params.append(product_id)
+    async with uow.transaction():
+        # Check if product exists and belongs to user
+        product = await uow.fetch("SELECT * FROM products WHERE id = $1 FOR UPDATE", [product_id])
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found")
+        
+        if product[0]["vendor_id"] != current_user["id"] and current_user["role"] != UserRole.ADMIN:
+            raise HTTPException(status_code=403, detail="Not authorized to update this product")
+        
+        # Build update query dynamically
+        update_fields = []
+        params = []
+        param_count = 1
+        
+        for field, value in product_update.dict(exclude_unset=True).items():
+            update_fields.append(f"{field} = ${param_count}")
+            params.append(value)
+            param_count += 1
+        
+        if not update_fields:
+            return product[0]
+        
+        query = f"UPDATE products SET {', '.join(update_fields)} WHERE id = ${param_count} RETURNING *"
+        params.append(product_id)
+        
+        result = await uow.fetch(query, params)
+        version = await notify_invalidation(uow, "product", product_id)
     
-    result = await sql(query, params)
+    apply_invalidation("product", product_id, version)
     return result[0]
 
 @app.delete("/vendor/products/{product_id}")
 async def delete_product(
     product_id: int,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    uow: UnitOfWork = Depends(get_unit_of_work)
 ):
-    product = await sql("SELECT * FROM products WHERE id = $1", [product_id])
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    
-    if product[0]["vendor_id"] != current_user["id"] and current_user["role"] != UserRole.ADMIN:
-        raise HTTPException(status_code=403, detail="Not authorized to delete this product")
+    async with uow.transaction():
+        product = await uow.fetch("SELECT * FROM products WHERE id = $1 FOR UPDATE", [product_id])
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found")
+        
+        if product[0]["vendor_id"] != current_user["id"] and current_user["role"] != UserRole.ADMIN:
+            raise HTTPException(status_code=403, detail="Not authorized to delete this product")
+        
+        await uow.fetch("UPDATE products SET is_active = false WHERE id = $1", [product_id])
+        version = await notify_invalidation(uow, "product", product_id)
     
-    await sql("UPDATE products SET is_active = false WHERE id = $1", [product_id])
+    apply_invalidation("product", product_id, version)
     return {"message": "Product deleted successfully"}
 
+# Recommendations ("frequently bought together")
+# A background job builds a sparse item-item co-occurrence matrix from order_items,
+# normalizes it with cosine similarity and keeps the top-K neighbours of every
+# product in CSR-style arrays. Every order status change that starts or stops an
+# order counting is broadcast from its transaction, and each process folds it in
+# (or back out) until an index whose build snapshot saw that transaction
+# replaces it.
+#
+# One process builds at a time (pg_try_advisory_lock). Each build is written to
+# its own generation directory, RECOMMENDATION_INDEX_DIR/current is swapped
+# atomically, and the generation is announced on the invalidation bus so the
+# other processes memory-map it. A host that does not share the directory builds
+# the announced generation itself, one process per host (flock).
+RECOMMENDATION_INDEX_DIR = os.getenv("RECOMMENDATION_INDEX_DIR", "/tmp/estore-recommendations")
+RECOMMENDATION_TOP_K = int(os.getenv("RECOMMENDATION_TOP_K", "20"))
+RECOMMENDATION_REBUILD_SECONDS = int(os.getenv("RECOMMENDATION_REBUILD_SECONDS", "3600"))
+RECOMMENDATION_EXCLUDED_STATUSES = ["pending_payment", "cancelled"]
+RECOMMENDATION_BUILD_LOCK_ID = 7271002
+RECOMMENDATION_KEEP_GENERATIONS = 3
+RECOMMENDATION_INDEX_ARRAYS = ("product_ids", "item_counts", "indptr", "neighbors", "counts", "scores")
+
+class RecommendationIndex:
+    # Neighbours of product_ids[i] live in neighbors[indptr[i]:indptr[i + 1]],
+    # ordered by descending score. product_ids is sorted for binary search.
+    def __init__(self, product_ids, item_counts, indptr, neighbors, counts, scores, watermark: int,
+                 snapshot: Optional[str] = None):
+        self.product_ids = product_ids
+        self.item_counts = item_counts
+        self.indptr = indptr
+        self.neighbors = neighbors
+        self.counts = counts
+        self.scores = scores
+        self.watermark = watermark
+        # txid_current_snapshot() of the build's reads, "xmin:xmax:xip,..."
+        self.snapshot = snapshot
+        self.snapshot_bounds = None
+        if snapshot:
+            xmin, xmax, in_progress = snapshot.split(":")
+            self.snapshot_bounds = (
+                int(xmin), int(xmax), frozenset(int(txid) for txid in in_progress.split(",") if txid)
+            )
+
+    @classmethod
+    def empty(cls, watermark: int = 0):
+        return cls(
+            np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.int64),
+            np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32),
+            watermark
+        )
+
+    def save(self, directory: str):
+        # directory must be new; generations are never written in place
+        os.makedirs(directory)
+        for name in RECOMMENDATION_INDEX_ARRAYS:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(directory, "watermark"), "w") as f:
+            f.write(str(self.watermark))
+        if self.snapshot:
+            with open(os.path.join(directory, "snapshot"), "w") as f:
+                f.write(self.snapshot)
+
+    @classmethod
+    def load(cls, directory: str):
+        # Memory-mapped so every worker shares the same pages
+        arrays = [
+            np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+            for name in RECOMMENDATION_INDEX_ARRAYS
+        ]
+        with open(os.path.join(directory, "watermark")) as f:
+            watermark = int(f.read())
+        snapshot = None
+        if os.path.exists(os.path.join(directory, "snapshot")):
+            with open(os.path.join(directory, "snapshot")) as f:
+                snapshot = f.read().strip()
+        return cls(*arrays, watermark, snapshot)
+
+    def covers(self, txid: int, order_id: int) -> bool:
+        # Whether the build already saw the transaction (txid_visible_in_snapshot);
+        # indexes built without a snapshot only know their order id watermark
+        if self.snapshot_bounds is None:
+            return order_id <= self.watermark
+        xmin, xmax, in_progress = self.snapshot_bounds
+        return txid < xmin or (txid < xmax and txid not in in_progress)
+
+    def row(self, product_id: int):
+        i = int(np.searchsorted(self.product_ids, product_id))
+        if i >= len(self.product_ids) or self.product_ids[i] != product_id:
+            return None
+        return i
+
+    def item_count(self, product_id: int) -> int:
+        i = self.row(product_id)
+        return 0 if i is None else int(self.item_counts[i])
+
+    def neighbours(self, product_id: int):
+        i = self.row(product_id)
+        if i is None:
+            return [], []
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.neighbors[start:end], self.counts[start:end]
+
+def build_recommendation_index(order_ids, product_ids, watermark: int, top_k: int) -> RecommendationIndex:
+    if len(order_ids) == 0:
+        return RecommendationIndex.empty(watermark)
+    
+    # One row per (order, product), sorted by order; repeated lines in an order count once
+    pairs = np.unique(np.stack([
+        np.asarray(order_ids, dtype=np.int64), np.asarray(product_ids, dtype=np.int64)
+    ], axis=1), axis=0)
+    orders = pairs[:, 0]
+    catalog, item_idx = np.unique(pairs[:, 1], return_inverse=True)
+    n = len(catalog)
+    item_counts = np.bincount(item_idx, minlength=n)
+    
+    # Expand every order of size k into its k * k (item, partner) pairs without a Python loop
+    _, order_start, order_size = np.unique(orders, return_index=True, return_counts=True)
+    size_per_item = np.repeat(order_size, order_size)
+    start_per_item = np.repeat(order_start, order_size)
+    left = np.repeat(item_idx, size_per_item)
+    block_start = np.repeat(np.cumsum(size_per_item) - size_per_item, size_per_item)
+    offset = np.arange(len(left)) - block_start
+    right = item_idx[np.repeat(start_per_item, size_per_item) + offset]
+    distinct = left != right
+    left, right = left[distinct], right[distinct]
+    
+    # Sparse COO co-occurrence counts, normalized by cosine similarity
+    keys, co_counts = np.unique(left * n + right, return_counts=True)
+    rows, cols = keys // n, keys % n
+    scores = co_counts / np.sqrt(item_counts[rows] * item_counts[cols])
+    
+    # Keep the top-K partners per row
+    order = np.lexsort((-scores, rows))
+    rows, cols, co_counts, scores = rows[order], cols[order], co_counts[order], scores[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    keep = rank < top_k
+    rows, cols, co_counts, scores = rows[keep], cols[keep], co_counts[keep], scores[keep]
+    
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=n))
+    return RecommendationIndex(
+        catalog, item_counts.astype(np.int32), indptr, catalog[cols],
+        co_counts.astype(np.int32), scores.astype(np.float32), watermark
+    )
+
+recommendation_index = RecommendationIndex.empty()
+# Order status changes the active index does not reflect yet, folded in until a
+# rebuild covers them: order id -> (product ids, [(txid, counted before,
+# counted after)]) in commit order, which is NOTIFY delivery order. A snapshot
+# sees a commit-order prefix of them, so the index reflects the "before" of the
+# first event it does not cover.
+recent_orders = {}
+recent_item_counts = {}
+recent_co_counts = {}
+
+def counts_for_recommendations(status: Optional[str]) -> bool:
+    return status is not None and status not in RECOMMENDATION_EXCLUDED_STATUSES
+
+def recent_order_delta(events: list) -> int:
+    return int(events[-1][2]) - int(events[0][1]) if events else 0
+
+def apply_recent_order(product_ids: List[int], delta: int):
+    for product_id in product_ids:
+        recent_item_counts[product_id] = recent_item_counts.get(product_id, 0) + delta
+        partners = recent_co_counts.setdefault(product_id, {})
+        for partner_id in product_ids:
+            if partner_id != product_id:
+                partners[partner_id] = partners.get(partner_id, 0) + delta
+
+@on_broadcast("order")
+def record_order_for_recommendations(message: dict):
+    order_id = message["order_id"]
+    if recommendation_index.covers(message["txid"], order_id):
+        return
+    items, events = recent_orders.setdefault(order_id, (list(dict.fromkeys(message["product_ids"])), []))
+    previous_delta = recent_order_delta(events)
+    events.append((message["txid"], message["before"], message["after"]))
+    delta = recent_order_delta(events) - previous_delta
+    if delta:
+        apply_recent_order(items, delta)
+
+async def notify_order_status(uow, order_id: int, before_status: Optional[str], after_status: str,
+                              product_ids: Optional[List[int]] = None):
+    # Must run inside the transaction that changes the order's status
+    before, after = counts_for_recommendations(before_status), counts_for_recommendations(after_status)
+    if before == after:
+        return
+    if product_ids is None:
+        rows = await uow.fetch("SELECT product_id FROM order_items WHERE order_id = $1", [order_id])
+        product_ids = [row["product_id"] for row in rows]
+    await notify_broadcast(uow, "order", {
+        "order_id": order_id, "product_ids": product_ids, "before": before, "after": after
+    })
+
+def swap_recommendation_index(index: RecommendationIndex):
+    global recommendation_index
+    recommendation_index = index
+    for order_id, (items, events) in list(recent_orders.items()):
+        remaining = [event for event in events if not index.covers(event[0], order_id)]
+        if remaining:
+            recent_orders[order_id] = (items, remaining)
+        else:
+            del recent_orders[order_id]
+    recent_item_counts.clear()
+    recent_co_counts.clear()
+    for items, events in recent_orders.values():
+        delta = recent_order_delta(events)
+        if delta:
+            apply_recent_order(items, delta)
+
+recommendation_generation = None
+
+def recommendation_generation_dir(generation: int) -> str:
+    return os.path.join(RECOMMENDATION_INDEX_DIR, "generations", str(generation))
+
+def build_and_save_recommendation_index(order_ids, product_ids, watermark: int, snapshot: str, generation: int):
+    index = build_recommendation_index(order_ids, product_ids, watermark, RECOMMENDATION_TOP_K)
+    index.snapshot = snapshot
+    index.save(recommendation_generation_dir(generation))
+    write_generation_pointer(RECOMMENDATION_INDEX_DIR, generation, RECOMMENDATION_KEEP_GENERATIONS)
+    return RecommendationIndex.load(recommendation_generation_dir(generation))
+
+async def reload_recommendation_index(generation: Optional[int] = None):
+    # generation: the announced one, which must be built here if this host does
+    # not share the builder's RECOMMENDATION_INDEX_DIR
+    global recommendation_generation
+    pointer = await asyncio.to_thread(read_generation_pointer, RECOMMENDATION_INDEX_DIR)
+    if generation is not None and (pointer is None or pointer[0] < generation):
+        await build_local_recommendation_generation(generation)
+        return
+    if pointer is None or pointer[0] == recommendation_generation:
+        return
+    try:
+        index = await asyncio.to_thread(RecommendationIndex.load, recommendation_generation_dir(pointer[0]))
+    except (OSError, ValueError):
+        logger.exception("Failed to load recommendation index generation %s", pointer[0])
+        return
+    recommendation_generation = pointer[0]
+    swap_recommendation_index(index)
+
+async def build_local_recommendation_generation(generation: int):
+    # Whoever gets the host lock builds; the others wait and load its result
+    while True:
+        lock_file = await asyncio.to_thread(try_lock_host_build, RECOMMENDATION_INDEX_DIR)
+        if lock_file is not None:
+            break
+        await asyncio.sleep(1)
+    try:
+        pointer = await asyncio.to_thread(read_generation_pointer, RECOMMENDATION_INDEX_DIR)
+        if pointer is None or pointer[0] < generation:
+            await build_recommendation_generation(generation)
+            return
+    finally:
+        lock_file.close()
+    await reload_recommendation_index()
+
+async def rebuild_recommendation_index():
+    async with advisory_lock(RECOMMENDATION_BUILD_LOCK_ID) as acquired:
+        if acquired:
+            pointer = await asyncio.to_thread(read_generation_pointer, RECOMMENDATION_INDEX_DIR)
+            if pointer is not None and time.time() - pointer[1] < RECOMMENDATION_REBUILD_SECONDS / 2:
+                # Another process built recently
+                await reload_recommendation_index()
+                return
+            generation = await build_recommendation_generation(time.time_ns())
+    if not acquired:
+        # The builder announces its generation when it is done; until then a host
+        # with no index of its own builds one
+        if await asyncio.to_thread(read_generation_pointer, RECOMMENDATION_INDEX_DIR) is None:
+            await build_local_recommendation_generation(time.time_ns())
+        return
+    await publish_invalidation("recommendation_index", generation)
+
+async def build_recommendation_generation(generation: int) -> int:
+    global recommendation_generation
+    pool = await get_db_pool()
+    conn = await acquire_connection(pool)
+    try:
+        # One snapshot for every read, recorded so order broadcasts can tell
+        # whether the index already includes them
+        async with conn.transaction(isolation="repeatable_read", readonly=True):
+            snapshot = await conn.fetchval("SELECT txid_current_snapshot()::text")
+            watermark = await conn.fetchval("SELECT COALESCE(MAX(id), 0) FROM orders")
+            rows = await fetch_dicts(conn, """
+                SELECT oi.order_id, oi.product_id
+                FROM order_items oi
+                JOIN orders o ON oi.order_id = o.id
+                WHERE o.status != ALL($1)
+            """, [RECOMMENDATION_EXCLUDED_STATUSES])
+    finally:
+        await pool.release(conn)
+    order_ids = [row["order_id"] for row in rows]
+    product_ids = [row["product_id"] for row in rows]
+    index = await asyncio.to_thread(
+        build_and_save_recommendation_index, order_ids, product_ids, watermark, snapshot, generation
+    )
+    recommendation_generation = generation
+    swap_recommendation_index(index)
+    return generation
+
+@on_invalidate("recommendation_index")
+def load_announced_recommendation_index(generation: int):
+    if generation != recommendation_generation:
+        spawn_background_task(reload_recommendation_index(generation))
+
+def get_recommendations(product_id: int, limit: int):
+    index = recommendation_index
+    item_count = index.item_count(product_id) + recent_item_counts.get(product_id, 0)
+    if item_count <= 0:
+        return []
+    
+    neighbors, counts = index.neighbours(product_id)
+    co_counts = {int(neighbor): int(count) for neighbor, count in zip(neighbors, counts)}
+    for partner_id, count in recent_co_counts.get(product_id, {}).items():
+        co_counts[partner_id] = co_counts.get(partner_id, 0) + count
+    
+    scored = []
+    for partner_id, count in co_counts.items():
+        partner_count = index.item_count(partner_id) + recent_item_counts.get(partner_id, 0)
+        if count <= 0 or partner_count <= 0:
+            # Cancelled since the last rebuild
+            continue
+        scored.append((partner_id, count / math.sqrt(item_count * partner_count)))
+    return heapq.nlargest(limit, scored, key=lambda item: item[1])
+
+async def recommendation_rebuild_loop():
+    while True:
+        try:
+            await rebuild_recommendation_index()
+        except Exception:
+            logger.exception("Recommendation index rebuild failed")
+        await asyncio.sleep(RECOMMENDATION_REBUILD_SECONDS)
+
+@app.on_event("startup")
+async def load_recommendation_index():
+    await reload_recommendation_index()
+    if DATABASE_URL and RECOMMENDATION_REBUILD_SECONDS > 0:
+        spawn_background_task(recommendation_rebuild_loop())
+
+@app.get("/products/{product_id}/recommendations")
+async def get_product_recommendations(product_id: int, limit: int = 10):
+    limit = max(1, min(limit, RECOMMENDATION_TOP_K))
+    recommendations = get_recommendations(product_id, limit)
+    scores = {partner_id: score for partner_id, score in recommendations}
+    batch = await get_products_batch(list(scores), ["id", "name", "price", "image_url"])
+    return {
+        "product_id": product_id,
+        "recommendations": [
+            {**product, "score": round(scores[product["id"]], 4)}
+            for product in batch["products"]
+        ]
+    }
+
 # Cart endpoints
+async def lock_cart(uow: UnitOfWork, user_id: int):
+    # Serializes a user's cart writes until commit: adding a product that is not
+    # in the cart yet has no cart_items row to lock
+    await uow.fetch("SELECT id FROM users WHERE id = $1 FOR NO KEY UPDATE", [user_id])
+
 @app.get("/cart")
 async def get_cart(current_user: dict = Depends(get_current_user)):
-    cart_items = await sql("""
-        SELECT ci.*, p.name, p.price, p.image_url 
-        FROM cart_items ci 
-        JOIN products p ON ci.product_id = p.id 
-        WHERE ci.user_id = $1
-    """, [current_user["id"]])
+    cart_items = await sql(CART_ITEMS_QUERY, [current_user["id"]])
     
     total = sum(item["price"] * item["quantity"] for item in cart_items)
     
@@ -496,33 +2531,37 @@ async def get_cart(current_user: dict = Depends(get_current_user)):
 @app.post("/cart/items")
 async def add_to_cart(
     cart_item: CartItemCreate,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    uow: UnitOfWork = Depends(get_unit_of_work)
 ):
-    # Check if product exists
-    product = await sql("SELECT * FROM products WHERE id = $1", [cart_item.product_id])
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    
-    # Check if item already in cart
-    existing_item = await sql(
-        "SELECT * FROM cart_items WHERE user_id = $1 AND product_id = $2",
-        [current_user["id"], cart_item.product_id]
-    )
-    
-    if existing_item:
-        # Update quantity
-        result = await sql(
-            "UPDATE cart_items SET quantity = quantity + $1 WHERE id = $2 RETURNING *",
-            [cart_item.quantity, existing_item[0]["id"]]
-        )
-        return result[0]
-    else:
-        # Create new cart item
-        result = await sql(
-            "INSERT INTO cart_items (user_id, product_id, quantity) VALUES ($1, $2, $3) RETURNING *",
-            [current_user["id"], cart_item.product_id, cart_item.quantity]
+    async with uow.transaction():
+        # Check if product exists
+        product = await uow.fetch("SELECT id FROM products WHERE id = $1", [cart_item.product_id])
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found")
+        
+        await lock_cart(uow, current_user["id"])
+        
+        # Check if item already in cart
+        existing_item = await uow.fetch(
+            "SELECT * FROM cart_items WHERE user_id = $1 AND product_id = $2",
+            [current_user["id"], cart_item.product_id]
         )
-        return result[0]
+        
+        if existing_item:
+            # Update quantity
+            result = await uow.fetch(
+                "UPDATE cart_items SET quantity = quantity + $1 WHERE id = $2 RETURNING *",
+                [cart_item.quantity, existing_item[0]["id"]]
+            )
+            return result[0]
+        else:
+            # Create new cart item
+            result = await uow.fetch(
+                "INSERT INTO cart_items (user_id, product_id, quantity) VALUES ($1, $2, $3) RETURNING *",
+                [current_user["id"], cart_item.product_id, cart_item.quantity]
+            )
+            return result[0]
 
 class CartItemUpdate(BaseModel):
     quantity: int
@@ -531,65 +2570,69 @@ class CartItemUpdate(BaseModel):
 async def update_cart_item(
     item_id: int,
     cart_update: CartItemUpdate,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    uow: UnitOfWork = Depends(get_unit_of_work)
 ):
-    cart_item = await sql(
-        "SELECT * FROM cart_items WHERE id = $1 AND user_id = $2",
-        [item_id, current_user["id"]]
-    )
-    
-    if not cart_item:
-        raise HTTPException(status_code=404, detail="Cart item not found")
-    
-    if cart_update.quantity <= 0:
-        # Remove item if quantity is 0 or less
-        await sql("DELETE FROM cart_items WHERE id = $1", [item_id])
-        return {"message": "Item removed from cart"}
-    else:
-        # Update quantity
-        result = await sql(
-            "UPDATE cart_items SET quantity = $1 WHERE id = $2 RETURNING *",
-            [cart_update.quantity, item_id]
+    async with uow.transaction():
+        await lock_cart(uow, current_user["id"])
+        cart_item = await uow.fetch(
+            "SELECT * FROM cart_items WHERE id = $1 AND user_id = $2",
+            [item_id, current_user["id"]]
         )
-        return result[0]
+        
+        if not cart_item:
+            raise HTTPException(status_code=404, detail="Cart item not found")
+        
+        if cart_update.quantity <= 0:
+            # Remove item if quantity is 0 or less
+            await uow.fetch("DELETE FROM cart_items WHERE id = $1", [item_id])
+            return {"message": "Item removed from cart"}
+        else:
+            # Update quantity
+            result = await uow.fetch(
+                "UPDATE cart_items SET quantity = $1 WHERE id = $2 RETURNING *",
+                [cart_update.quantity, item_id]
+            )
+            return result[0]
 
 @app.delete("/cart/items/{item_id}")
 async def remove_from_cart(
     item_id: int,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    uow: UnitOfWork = Depends(get_unit_of_work)
 ):
-    cart_item = await sql(
-        "SELECT * FROM cart_items WHERE id = $1 AND user_id = $2",
-        [item_id, current_user["id"]]
-    )
-    
-    if not cart_item:
-        raise HTTPException(status_code=404, detail="Cart item not found")
+    async with uow.transaction():
+        await lock_cart(uow, current_user["id"])
+        cart_item = await uow.fetch(
+            "DELETE FROM cart_items WHERE id = $1 AND user_id = $2 RETURNING id",
+            [item_id, current_user["id"]]
+        )
+        
+        if not cart_item:
+            raise HTTPException(status_code=404, detail="Cart item not found")
     
-    await sql("DELETE FROM cart_items WHERE id = $1", [item_id])
     return {"message": "Item removed from cart"}
 
 # PayPal Payment endpoints
+async def insert_order_items(uow: UnitOfWork, order_id: int, cart_items: List[dict]):
+    await uow.executemany(
+        "INSERT INTO order_items (order_id, product_id, quantity, price) VALUES ($1, $2, $3, $4)",
+        [(order_id, item["product_id"], item["quantity"], item["price"]) for item in cart_items]
+    )
+
 @app.post("/checkout")
 async def create_payment(
     checkout_data: CheckoutRequest,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    uow: UnitOfWork = Depends(get_unit_of_work)
 ):
-    # Get cart items
-    cart_items = await sql("""
-        SELECT ci.*, p.name, p.price, p.image_url 
-        FROM cart_items ci 
-        JOIN products p ON ci.product_id = p.id 
-        WHERE ci.user_id = $1
-    """, [current_user["id"]])
-    
-    if not cart_items:
-        raise HTTPException(status_code=400, detail="Cart is empty")
-    
-    # Calculate total
-    total_amount = sum(item["price"] * item["quantity"] for item in cart_items)
-    
     if checkout_data.payment_method == "paypal" and paypal_client_id:
+        # Read outside a transaction: no locks are held across the PayPal round trip
+        cart_items = await uow.fetch(CART_ITEMS_QUERY, [current_user["id"]])
+        if not cart_items:
+            raise HTTPException(status_code=400, detail="Cart is empty")
+        total_amount = sum(item["price"] * item["quantity"] for item in cart_items)
+        
         # Create PayPal payment
         items = []
         for item in cart_items:
@@ -622,20 +2665,18 @@ async def create_payment(
             }]
         })
         
-        if payment.create():
-            # Store payment info temporarily (you might want to create a payments table)
-            order_result = await sql(
-                "INSERT INTO orders (user_id, total_amount, payment_intent_id, status) VALUES ($1, $2, $3, $4) RETURNING *",
-                [current_user["id"], total_amount, payment.id, "pending_payment"]
-            )
-            order = order_result[0]
-            
-            # Create order items
-            for cart_item in cart_items:
-                await sql(
-                    "INSERT INTO order_items (order_id, product_id, quantity, price) VALUES ($1, $2, $3, $4)",
-                    [order["id"], cart_item["product_id"], cart_item["quantity"], cart_item["price"]]
+        with profile_span("paypal"):
+            payment_created = payment.create()
+        if payment_created:
+            # Store payment info temporarily (you might want to create a payments table);
+            # the order and its items are committed together
+            async with uow.transaction():
+                order_result = await uow.fetch(
+                    "INSERT INTO orders (user_id, total_amount, payment_intent_id, status) VALUES ($1, $2, $3, $4) RETURNING *",
+                    [current_user["id"], total_amount, payment.id, "pending_payment"]
                 )
+                order = order_result[0]
+                await insert_order_items(uow, order["id"], cart_items)
             
             # Get approval URL
             approval_url = None
@@ -654,22 +2695,27 @@ async def create_payment(
             raise HTTPException(status_code=400, detail=f"PayPal payment creation failed: {payment.error}")
     
     else:
-        # Fallback to mock payment for other methods
-        order_result = await sql(
-            "INSERT INTO orders (user_id, total_amount, payment_intent_id) VALUES ($1, $2, $3) RETURNING *",
-            [current_user["id"], total_amount, f"mock_{int(datetime.utcnow().timestamp())}"]
-        )
-        order = order_result[0]
-        
-        # Create order items
-        for cart_item in cart_items:
-            await sql(
-                "INSERT INTO order_items (order_id, product_id, quantity, price) VALUES ($1, $2, $3, $4)",
-                [order["id"], cart_item["product_id"], cart_item["quantity"], cart_item["price"]]
+        # Fallback to mock payment for other methods. The cart is locked so the
+        # order, its items and the cleared cart all reflect the same cart.
+        async with uow.transaction():
+            await lock_cart(uow, current_user["id"])
+            cart_items = await uow.fetch(CART_ITEMS_QUERY, [current_user["id"]])
+            if not cart_items:
+                raise HTTPException(status_code=400, detail="Cart is empty")
+            total_amount = sum(item["price"] * item["quantity"] for item in cart_items)
+            
+            order_result = await uow.fetch(
+                "INSERT INTO orders (user_id, total_amount, payment_intent_id) VALUES ($1, $2, $3) RETURNING *",
+                [current_user["id"], total_amount, f"mock_{int(datetime.utcnow().timestamp())}"]
             )
-        
-        # Clear cart
-        await sql("DELETE FROM cart_items WHERE user_id = $1", [current_user["id"]])
+            order = order_result[0]
+            await insert_order_items(uow, order["id"], cart_items)
+            await notify_order_status(
+                uow, order["id"], None, order["status"], [item["product_id"] for item in cart_items]
+            )
+            
+            # Clear cart
+            await uow.fetch("DELETE FROM cart_items WHERE user_id = $1", [current_user["id"]])
         
         return {
             "order_id": order["id"],
@@ -681,27 +2727,34 @@ async def create_payment(
 @app.post("/payment/execute")
 async def execute_payment(
     payment_data: PayPalExecuteRequest,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    uow: UnitOfWork = Depends(get_unit_of_work)
 ):
     try:
         # Find the payment and execute it
-        payment = paypalrestsdk.Payment.find(payment_data.payment_id)
+        with profile_span("paypal"):
+            payment = paypalrestsdk.Payment.find(payment_data.payment_id)
+            payment_executed = payment.execute({"payer_id": payment_data.payer_id})
         
-        if payment.execute({"payer_id": payment_data.payer_id}):
-            # Payment successful, update order status
-            await sql(
-                "UPDATE orders SET status = 'created' WHERE payment_intent_id = $1 AND user_id = $2",
-                [payment_data.payment_id, current_user["id"]]
-            )
-            
-            # Clear cart
-            await sql("DELETE FROM cart_items WHERE user_id = $1", [current_user["id"]])
-            
-            # Get order details
-            order = await sql(
-                "SELECT * FROM orders WHERE payment_intent_id = $1 AND user_id = $2",
-                [payment_data.payment_id, current_user["id"]]
-            )
+        if payment_executed:
+            async with uow.transaction():
+                # Payment successful, update order status
+                order = await uow.fetch("""
+                    UPDATE orders o SET status = 'created'
+                    FROM (
+                        SELECT id, status FROM orders
+                        WHERE payment_intent_id = $1 AND user_id = $2
+                        FOR UPDATE
+                    ) previous
+                    WHERE o.id = previous.id
+                    RETURNING o.*, previous.status AS previous_status
+                """, [payment_data.payment_id, current_user["id"]])
+                if order:
+                    await notify_order_status(uow, order[0]["id"], order[0]["previous_status"], "created")
+                
+                # Clear cart
+                await lock_cart(uow, current_user["id"])
+                await uow.fetch("DELETE FROM cart_items WHERE user_id = $1", [current_user["id"]])
             
             return {
                 "status": "success",
@@ -783,17 +2836,20 @@ async def get_order_details(
 @app.put("/orders/{order_id}/cancel")
 async def cancel_order(
     order_id: int,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    uow: UnitOfWork = Depends(get_unit_of_work)
 ):
-    order = await sql("SELECT * FROM orders WHERE id = $1 AND user_id = $2", [order_id, current_user["id"]])
-    
-    if not order:
-        raise HTTPException(status_code=404, detail="Order not found")
-    
-    if order[0]["status"] not in ["created", "pending_payment"]:
-        raise HTTPException(status_code=400, detail="Cannot cancel order that is not in created or pending status")
-    
-    await sql("UPDATE orders SET status = 'cancelled' WHERE id = $1", [order_id])
+    async with uow.transaction():
+        order = await uow.fetch("SELECT * FROM orders WHERE id = $1 AND user_id = $2 FOR UPDATE", [order_id, current_user["id"]])
+        
+        if not order:
+            raise HTTPException(status_code=404, detail="Order not found")
+        
+        if order[0]["status"] not in ["created", "pending_payment"]:
+            raise HTTPException(status_code=400, detail="Cannot cancel order that is not in created or pending status")
+        
+        await uow.fetch("UPDATE orders SET status = 'cancelled' WHERE id = $1", [order_id])
+        await notify_order_status(uow, order_id, order[0]["status"], "cancelled")
     
     return {"message": "Order cancelled successfully"}
 
@@ -804,7 +2860,8 @@ class OrderStatusUpdate(BaseModel):
 async def update_order_status(
     order_id: int,
     status_update: OrderStatusUpdate,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    uow: UnitOfWork = Depends(get_unit_of_work)
 ):
     # Check if user is admin or vendor
     if current_user["role"] not in [UserRole.ADMIN, UserRole.VENDOR]:
@@ -815,18 +2872,145 @@ async def update_order_status(
     if status_update.status not in valid_statuses:
         raise HTTPException(status_code=400, detail=f"Invalid status. Must be one of: {valid_statuses}")
     
-    # Update order status
-    result = await sql(
-        "UPDATE orders SET status = $1 WHERE id = $2 RETURNING *",
-        [status_update.status, order_id]
-    )
-    
-    if not result:
-        raise HTTPException(status_code=404, detail="Order not found")
+    async with uow.transaction():
+        order = await uow.fetch("SELECT status FROM orders WHERE id = $1 FOR UPDATE", [order_id])
+        if not order:
+            raise HTTPException(status_code=404, detail="Order not found")
+        
+        # Update order status
+        await uow.fetch("UPDATE orders SET status = $1 WHERE id = $2", [status_update.status, order_id])
+        await notify_order_status(uow, order_id, order[0]["status"], status_update.status)
     
     return {"message": f"Order status updated to {status_update.status}"}
 
-# This is the entry point for Vercel
+# Admin profiling endpoints
+class ProfilingSettingsUpdate(BaseModel):
+    sample_rate: float
+
+def require_admin(current_user: dict):
+    if current_user["role"] != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Not authorized to access profiling data")
+
+@app.get("/admin/profiling")
+async def get_profiling_summary(current_user: dict = Depends(get_current_user)):
+    require_admin(current_user)
+    profiles, workers = await asyncio.to_thread(merged_route_profiles)
+    return {
+        "sample_rate": PROFILE_SAMPLE_RATE,
+        "debug_header_enabled": bool(PROFILE_DEBUG_TOKEN),
+        "interval_ms": PROFILE_INTERVAL_MS,
+        "workers": workers,
+        "routes": {route: route_profile.summary() for route, route_profile in profiles.items()}
+    }
+
+@app.put("/admin/profiling")
+async def update_profiling_settings(
+    settings: ProfilingSettingsUpdate,
+    current_user: dict = Depends(get_current_user),
+    uow: UnitOfWork = Depends(get_unit_of_work)
+):
+    require_admin(current_user)
+    if not 0 <= settings.sample_rate <= 1:
+        raise HTTPException(status_code=400, detail="sample_rate must be between 0 and 1")
+    async with uow.transaction():
+        # Taken before the txid is assigned, so versions follow commit order
+        await uow.fetch("SELECT pg_advisory_xact_lock($1)", [PROFILE_SETTINGS_LOCK_ID])
+        version = (await uow.fetch("SELECT txid_current() AS version"))[0]["version"]
+        await notify_broadcast(uow, "profile_settings", {"sample_rate": settings.sample_rate})
+    # Also saved here in case this worker's listener is down
+    try:
+        await asyncio.to_thread(save_profile_settings, settings.sample_rate, version)
+    except OSError:
+        logger.exception("Failed to save profiling settings to %s", PROFILE_SETTINGS_FILE)
+    return {"sample_rate": settings.sample_rate}
+
+@app.get("/admin/profiling/stacks")
+async def download_profiling_stacks(
+    route: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    require_admin(current_user)
+    profiles, _ = await asyncio.to_thread(merged_route_profiles)
+    lines = []
+    for key, route_profile in profiles.items():
+        if route and key != route:
+            continue
+        # The route is the root frame so one file can hold every route
+        for stack, count in route_profile.stacks.items():
+            lines.append(f"{key};{stack} {count}" if not route else f"{stack} {count}")
+    return Response(
+        content="\n".join(lines) + "\n",
+        media_type="text/plain",
+        headers={"Content-Disposition": 'attachment; filename="profile.folded"'}
+    )
+
+def remove_profile_files():
+    try:
+        names = os.listdir(PROFILE_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name.startswith("worker-"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, name))
+            except FileNotFoundError:
+                pass
+
+@app.delete("/admin/profiling")
+async def reset_profiling_data(current_user: dict = Depends(get_current_user)):
+    require_admin(current_user)
+    if await publish_invalidation("profile_reset", 0) is None:
+        raise HTTPException(status_code=503, detail="Could not broadcast the reset to the workers")
+    # Live workers remove their own files; this also drops exited workers' files
+    await asyncio.to_thread(remove_profile_files)
+    return {"message": "Profiling data cleared"}
+
+@app.on_event("startup")
+async def load_profile_settings():
+    reload_profile_settings()
+
+@app.on_event("shutdown")
+async def flush_profile_on_shutdown():
+    if profiler_thread is not None:
+        try:
+            await flush_profile()
+        except OSError:
+            logger.exception("Failed to write profile data to %s", PROFILE_DIR)
+
+# Startup warmup
+# Enabled by serve.py so pre-forked workers open their pool connections, prime
+# the statement cache for hot queries and fill the product cache before they
+# accept traffic. Left off by default to keep serverless cold starts short.
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "0") == "1"
+WARMUP_QUERIES = [
+    (PRODUCT_BY_ID_QUERY, [0]),
+    (PRODUCTS_BY_IDS_QUERY, [[0]]),
+    (USER_BY_EMAIL_AND_ID_QUERY, ["", 0]),
+    (CART_ITEMS_QUERY, [0]),
+]
+
+@app.on_event("startup")
+async def warm_up_worker():
+    if not WARMUP_ON_STARTUP or not DATABASE_URL:
+        return
+    try:
+        pool = await get_db_pool()
+        connections = [await pool.acquire() for _ in range(DB_POOL_MIN_SIZE)]
+        try:
+            for conn in connections:
+                for query, params in WARMUP_QUERIES:
+                    await conn.fetch(query, *params)
+        finally:
+            for conn in connections:
+                await pool.release(conn)
+        
+        # Fill the product cache through the batch path so the fills are guarded
+        page = await query_products_page(0, SNAPSHOT_PAGE_LIMIT)
+        await get_products_batch([product["id"] for product in page["products"]])
+    except Exception:
+        logger.exception("Worker warmup failed")
+
+# Local development server; use serve.py for the multi-worker production server
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,135 @@
+"""Production server entry point.
+
+Pre-forks WORKERS uvicorn workers (uvloop + httptools) under gunicorn and sizes
+each worker's DB pool so the cluster stays under Postgres max_connections.
+Run with ``python serve.py``.
+"""
+import logging
+import multiprocessing
+import os
+import resource
+import signal
+import sys
+
+from dotenv import load_dotenv
+from gunicorn.app.base import BaseApplication
+from uvicorn.workers import UvicornWorker
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+WORKERS = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+
+# Connection budget shared by every worker; the reserve covers psql sessions and
+# migrations
+PG_MAX_CONNECTIONS = int(os.getenv("PG_MAX_CONNECTIONS", "100"))
+PG_RESERVED_CONNECTIONS = int(os.getenv("PG_RESERVED_CONNECTIONS", "10"))
+# Connections each worker opens outside its pool: the invalidation LISTEN
+# session, plus the advisory lock sessions of the snapshot publisher, the
+# recommendation builder and the suggest index builder, which can all be open
+# at once
+DEDICATED_CONNECTIONS_PER_WORKER = 4
+
+# Worker recycling
+MAX_REQUESTS = int(os.getenv("MAX_REQUESTS", "10000"))
+MAX_REQUESTS_JITTER = int(os.getenv("MAX_REQUESTS_JITTER", "1000"))
+MAX_WORKER_RSS_MB = int(os.getenv("MAX_WORKER_RSS_MB", "512"))
+RSS_CHECK_EVERY_REQUESTS = 100
+
+# Long enough for in-flight checkouts (PayPal round trips) to finish on SIGTERM
+GRACEFUL_TIMEOUT_SECONDS = int(os.getenv("GRACEFUL_TIMEOUT_SECONDS", "30"))
+
+
+def configure_worker_pools(workers: int):
+    budget = PG_MAX_CONNECTIONS - PG_RESERVED_CONNECTIONS
+    per_worker = budget // workers - DEDICATED_CONNECTIONS_PER_WORKER
+    if per_worker < 1:
+        raise SystemExit(
+            f"{workers} workers need at least {workers * (DEDICATED_CONNECTIONS_PER_WORKER + 1)} connections, "
+            f"but only {budget} are available (PG_MAX_CONNECTIONS - PG_RESERVED_CONNECTIONS)"
+        )
+    os.environ["DB_POOL_MAX_SIZE"] = str(per_worker)
+    os.environ["DB_POOL_MIN_SIZE"] = str(min(int(os.getenv("DB_POOL_MIN_SIZE", "1")), per_worker))
+    os.environ.setdefault("WARMUP_ON_STARTUP", "1")
+    return per_worker
+
+
+def worker_rss_mb() -> float:
+    # Current resident set size; the second field of statm is resident pages
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        # No procfs (e.g. macOS dev machines): fall back to the peak RSS, in
+        # bytes on macOS and KiB elsewhere
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class RecycleOnMemoryLimit:
+    # Gracefully stops the worker once its RSS passes MAX_WORKER_RSS_MB; the
+    # gunicorn arbiter then forks a fresh one
+    def __init__(self, app, max_rss_mb: int):
+        self.app = app
+        self.max_rss_mb = max_rss_mb
+        self.requests = 0
+        self.recycling = False
+
+    async def __call__(self, scope, receive, send):
+        await self.app(scope, receive, send)
+        if scope["type"] != "http" or self.recycling:
+            return
+        self.requests += 1
+        if self.requests % RSS_CHECK_EVERY_REQUESTS == 0:
+            rss_mb = worker_rss_mb()
+            if rss_mb > self.max_rss_mb:
+                self.recycling = True
+                logger.warning("Worker %s at %.0f MB RSS, recycling", os.getpid(), rss_mb)
+                os.kill(os.getpid(), signal.SIGTERM)
+
+
+class ServerWorker(UvicornWorker):
+    CONFIG_KWARGS = {"loop": "uvloop", "http": "httptools", "lifespan": "on"}
+
+
+class Server(BaseApplication):
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # Imported after fork so every worker builds its own pool and caches;
+        # lifespan startup (warmup included) completes before it accepts traffic
+        from main import app
+        if MAX_WORKER_RSS_MB > 0:
+            return RecycleOnMemoryLimit(app, MAX_WORKER_RSS_MB)
+        return app
+
+
+def run():
+    logging.basicConfig(level=logging.INFO)
+    per_worker = configure_worker_pools(WORKERS)
+    logger.info("Starting %s workers with up to %s DB connections each", WORKERS, per_worker)
+    Server({
+        "bind": f"{HOST}:{PORT}",
+        "workers": WORKERS,
+        "worker_class": "serve.ServerWorker",
+        "preload_app": False,
+        "max_requests": MAX_REQUESTS,
+        "max_requests_jitter": MAX_REQUESTS_JITTER,
+        "graceful_timeout": GRACEFUL_TIMEOUT_SECONDS,
+        "timeout": GRACEFUL_TIMEOUT_SECONDS * 2,
+        "keepalive": 5,
+    }).run()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,158 @@
+import math
+import random
+from collections import Counter, defaultdict
+
+import numpy as np
+import pytest
+
+import main
+from main import RecommendationIndex, build_recommendation_index
+
+
+def brute_force(order_ids, product_ids):
+    baskets = defaultdict(set)
+    for order_id, product_id in zip(order_ids, product_ids):
+        baskets[order_id].add(product_id)
+    item_counts = Counter()
+    co_counts = defaultdict(Counter)
+    for basket in baskets.values():
+        for product_id in basket:
+            item_counts[product_id] += 1
+            for partner_id in basket:
+                if partner_id != product_id:
+                    co_counts[product_id][partner_id] += 1
+    return item_counts, co_counts
+
+
+def assert_matches_brute_force(index, order_ids, product_ids, top_k):
+    item_counts, co_counts = brute_force(order_ids, product_ids)
+    assert index.product_ids.tolist() == sorted(item_counts)
+    for product_id, item_count in item_counts.items():
+        assert index.item_count(product_id) == item_count
+        expected_scores = sorted(
+            (count / math.sqrt(item_count * item_counts[partner_id])
+             for partner_id, count in co_counts[product_id].items()),
+            reverse=True
+        )[:top_k]
+        neighbours, counts = index.neighbours(product_id)
+        i = index.row(product_id)
+        scores = index.scores[index.indptr[i]:index.indptr[i + 1]]
+        # Ties at the cut may keep a different partner, so compare the scores
+        # and check each kept partner against the brute-force counts
+        np.testing.assert_allclose(scores, expected_scores, rtol=1e-6)
+        for neighbour, count in zip(neighbours.tolist(), counts.tolist()):
+            assert co_counts[product_id][neighbour] == count
+
+
+def test_pairs_expand_within_each_order_only():
+    index = build_recommendation_index([1, 1, 1, 2, 2], [10, 11, 12, 10, 13], watermark=2, top_k=10)
+    neighbours, counts = index.neighbours(10)
+    assert sorted(zip(neighbours.tolist(), counts.tolist())) == [(11, 1), (12, 1), (13, 1)]
+    neighbours, _ = index.neighbours(13)
+    assert neighbours.tolist() == [10]
+    assert index.item_count(10) == 2
+    assert index.watermark == 2
+
+
+def test_repeated_lines_in_an_order_count_once():
+    index = build_recommendation_index([1, 1, 1], [10, 10, 11], watermark=1, top_k=10)
+    assert index.item_count(10) == 1
+    neighbours, counts = index.neighbours(10)
+    assert neighbours.tolist() == [11]
+    assert counts.tolist() == [1]
+
+
+def test_top_k_keeps_best_scoring_partners():
+    # 10 co-occurs with 11 three times, with 12 twice and with 13 once
+    order_ids = [1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 6, 6]
+    product_ids = [10, 11, 10, 11, 10, 11, 10, 12, 10, 12, 10, 13]
+    index = build_recommendation_index(order_ids, product_ids, watermark=6, top_k=2)
+    neighbours, counts = index.neighbours(10)
+    assert neighbours.tolist() == [11, 12]
+    assert counts.tolist() == [3, 2]
+    assert all(index.indptr[i + 1] - index.indptr[i] <= 2 for i in range(len(index.product_ids)))
+
+
+def test_unknown_product_and_empty_index():
+    index = build_recommendation_index([], [], watermark=0, top_k=5)
+    assert len(index.product_ids) == 0
+    assert index.neighbours(1) == ([], [])
+    assert index.item_count(1) == 0
+
+
+def test_matches_brute_force_on_random_orders():
+    rng = random.Random(7)
+    order_ids, product_ids = [], []
+    for order_id in range(1, 300):
+        for _ in range(rng.randint(1, 6)):
+            order_ids.append(order_id)
+            product_ids.append(rng.randint(1, 40))
+    for top_k in (1, 3, 50):
+        index = build_recommendation_index(order_ids, product_ids, watermark=299, top_k=top_k)
+        assert_matches_brute_force(index, order_ids, product_ids, top_k)
+
+
+def test_save_and_load_round_trip(tmp_path):
+    index = build_recommendation_index([1, 1, 2, 2], [10, 11, 10, 12], watermark=2, top_k=5)
+    index.save(str(tmp_path / "generation"))
+    loaded = RecommendationIndex.load(str(tmp_path / "generation"))
+    assert loaded.watermark == 2
+    for product_id in (10, 11, 12):
+        assert [a.tolist() for a in loaded.neighbours(product_id)] == [
+            a.tolist() for a in index.neighbours(product_id)
+        ]
+
+
+def test_covers_follows_snapshot_visibility():
+    index = build_recommendation_index([1], [10], watermark=1, top_k=5)
+    assert index.covers(txid=500, order_id=1)
+    assert not index.covers(txid=500, order_id=2)
+    index = RecommendationIndex(*[getattr(index, name) for name in main.RECOMMENDATION_INDEX_ARRAYS], 1, "100:105:101,103")
+    assert index.covers(99, order_id=50)
+    assert index.covers(102, order_id=50)
+    assert not index.covers(101, order_id=1)
+    assert not index.covers(105, order_id=1)
+
+
+def order_message(txid, order_id, product_ids, before, after):
+    return {"kind": "order", "txid": txid, "order_id": order_id, "product_ids": product_ids,
+            "before": before, "after": after}
+
+
+@pytest.fixture
+def recent_state(monkeypatch):
+    monkeypatch.setattr(main, "recent_orders", {})
+    monkeypatch.setattr(main, "recent_item_counts", {})
+    monkeypatch.setattr(main, "recent_co_counts", {})
+    base = build_recommendation_index([1, 1], [10, 11], watermark=1, top_k=5)
+    arrays = [getattr(base, name) for name in main.RECOMMENDATION_INDEX_ARRAYS]
+    monkeypatch.setattr(main, "recommendation_index", RecommendationIndex(*arrays, 1, "100:100:"))
+    return arrays
+
+
+def test_broadcast_orders_are_folded_in_and_cancelled_out(recent_state):
+    main.record_order_for_recommendations(order_message(120, 2, [10, 12], False, True))
+    assert main.recent_item_counts == {10: 1, 12: 1}
+    assert [partner for partner, _ in main.get_recommendations(10, 5)] == [11, 12]
+    
+    main.record_order_for_recommendations(order_message(130, 2, [10, 12], True, False))
+    assert main.recent_item_counts == {10: 0, 12: 0}
+    assert [partner for partner, _ in main.get_recommendations(10, 5)] == [11]
+
+
+def test_cancelling_an_indexed_order_takes_it_out(recent_state):
+    # Order 1 is in the index (txid 50 is visible to the build snapshot)
+    main.record_order_for_recommendations(order_message(50, 1, [10, 11], False, True))
+    assert main.recent_orders == {}
+    main.record_order_for_recommendations(order_message(140, 1, [10, 11], True, False))
+    assert main.get_recommendations(10, 5) == []
+
+
+def test_swap_drops_events_the_new_index_covers(recent_state):
+    main.record_order_for_recommendations(order_message(120, 2, [10, 12], False, True))
+    main.record_order_for_recommendations(order_message(130, 3, [11, 12], False, True))
+    rebuilt = build_recommendation_index([1, 1, 2, 2], [10, 11, 10, 12], watermark=2, top_k=5)
+    rebuilt.snapshot_bounds = (125, 125, frozenset())
+    main.swap_recommendation_index(rebuilt)
+    assert list(main.recent_orders) == [3]
+    assert main.recent_item_counts == {11: 1, 12: 1}
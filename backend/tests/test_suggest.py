@@ -0,0 +1,120 @@
+import random
+
+import main
+from main import build_suggest_index, get_suggestions, suggest_key
+
+
+def product(product_id, name, category=None):
+    return {"id": product_id, "name": name, "category": category}
+
+
+def brute_force_range(index, prefix):
+    return [i for i in range(len(index)) if index.key(i).startswith(prefix)]
+
+
+def test_keys_are_sorted_and_lower_bound_matches_linear_scan():
+    rng = random.Random(3)
+    words = ["".join(rng.choice("abcé") for _ in range(rng.randint(1, 6))) for _ in range(200)]
+    index = build_suggest_index([product(i + 1, word) for i, word in enumerate(words)], {})
+    keys = [index.key(i) for i in range(len(index))]
+    assert keys == sorted(keys)
+    for target in [b"", b"a", b"ab", b"c\xc3", b"zz"] + [suggest_key(word) for word in words[:20]]:
+        assert index.lower_bound(target) == sum(key < target for key in keys)
+
+
+def test_prefix_range_matches_linear_scan():
+    names = ["Apple", "apricot", "Banana", "band", "Bänd", "APPLE pie", "cherry"]
+    index = build_suggest_index([product(i + 1, name) for i, name in enumerate(names)], {})
+    for prefix in [b"", b"a", b"ap", b"app", b"b", b"ba", suggest_key("bä"), b"c", b"x"]:
+        lo, hi = index.prefix_range(prefix)
+        assert list(range(lo, hi)) == brute_force_range(index, prefix)
+
+
+def test_top_orders_by_popularity_and_includes_categories():
+    products = [product(1, "lamp", "lighting"), product(2, "ladder", "tools"), product(3, "laptop", "computers")]
+    index = build_suggest_index(products, {1: 5, 2: 1, 3: 9})
+    top = index.top(b"l", 3)
+    displays = [index.display(i) for i in top]
+    assert displays[:2] == ["laptop", "lamp"]
+    assert "lighting" in displays
+    assert index.categories == ["lighting", "tools", "computers"]
+
+
+def test_prewarm_caches_wide_prefixes(monkeypatch):
+    monkeypatch.setattr(main, "SUGGEST_SCAN_LIMIT", 4)
+    names = [f"a{i:02d}" for i in range(10)] + ["b1", "b2"]
+    popularity = {i + 1: float(i) for i in range(len(names))}
+    index = build_suggest_index([product(i + 1, name) for i, name in enumerate(names)], popularity)
+    # "a" and "a0" cover more than SUGGEST_SCAN_LIMIT entries, "b" does not
+    assert set(index.top_cache) == {b"a", b"a0"}
+    cached = index.top_cache[b"a"]
+    assert [index.refs[i] for i in cached] == list(range(10, 0, -1))
+    assert index.top(b"a", 2) == cached[:4]
+    assert [index.display(i) for i in index.top(b"b", 5)] == ["b2", "b1"]
+
+
+def test_overlay_shadows_index_entries(monkeypatch):
+    products = [product(1, "lamp"), product(2, "ladder"), product(3, "laptop")]
+    index = build_suggest_index(products, {1: 5, 2: 1, 3: 9})
+    overlay = {
+        # Renamed, deactivated and newly created products
+        ("product", 1): (suggest_key("Desk lamp"), "Desk lamp", 5),
+        ("product", 3): None,
+        ("product", 4): (suggest_key("lantern"), "lantern", 0),
+    }
+    monkeypatch.setattr(main, "suggest_index", index)
+    monkeypatch.setattr(main, "suggest_overlay", overlay)
+    assert get_suggestions("la", 5) == [
+        {"type": "product", "text": "ladder", "product_id": 2},
+        {"type": "product", "text": "lantern", "product_id": 4},
+    ]
+    assert get_suggestions("desk", 5) == [{"type": "product", "text": "Desk lamp", "product_id": 1}]
+
+
+def test_overlay_category_is_suggested(monkeypatch):
+    index = build_suggest_index([product(1, "lamp", "lighting")], {1: 2})
+    monkeypatch.setattr(main, "suggest_index", index)
+    monkeypatch.setattr(main, "suggest_overlay", {("category", "lanterns"): (b"lanterns", "lanterns", 0)})
+    assert get_suggestions("L", 5) == [
+        {"type": "product", "text": "lamp", "product_id": 1},
+        {"type": "category", "text": "lighting"},
+        {"type": "category", "text": "lanterns"},
+    ]
+
+
+def test_saved_index_loads_with_same_answers(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "SUGGEST_SCAN_LIMIT", 4)
+    names = [f"a{i:02d}" for i in range(10)] + ["bé", "b2"]
+    popularity = {i + 1: float(i) for i in range(len(names))}
+    index = build_suggest_index([product(i + 1, name, "cat") for i, name in enumerate(names)], popularity, 42)
+    index.save(str(tmp_path / "1"))
+    loaded = main.SuggestIndex.load(str(tmp_path / "1"))
+    assert [loaded.key(i) for i in range(len(loaded))] == [index.key(i) for i in range(len(index))]
+    assert [loaded.display(i) for i in range(len(loaded))] == [index.display(i) for i in range(len(index))]
+    assert loaded.top_cache == index.top_cache
+    assert loaded.top(b"a", 3) == index.top(b"a", 3)
+    assert loaded.categories == ["cat"]
+    assert loaded.covered_xmin == 42
+    assert loaded.product_popularity_of(5) == 4.0
+    assert loaded.product_popularity_of(99) == 0
+    assert loaded.memory_bytes() == index.memory_bytes()
+
+
+def test_suggestions_look_past_shadowed_candidates(monkeypatch):
+    names = [f"lamp {i}" for i in range(10)]
+    index = build_suggest_index([product(i + 1, name) for i, name in enumerate(names)], {i + 1: i for i in range(10)})
+    # The six most popular are deactivated, more than limit * 2 - limit of the candidates
+    overlay = {("product", product_id): None for product_id in range(5, 11)}
+    monkeypatch.setattr(main, "suggest_index", index)
+    monkeypatch.setattr(main, "suggest_overlay", overlay)
+    assert [s["product_id"] for s in get_suggestions("lamp", 3)] == [4, 3, 2]
+
+
+def test_swap_keeps_overlay_entries_newer_than_the_build(monkeypatch):
+    overlay = {("product", 1): None, ("product", 2): None, ("category", "new"): (b"new", "new", 0)}
+    versions = {("product", 1): 90, ("product", 2): 110, ("category", "new"): 90}
+    monkeypatch.setattr(main, "suggest_overlay", overlay)
+    monkeypatch.setattr(main, "suggest_overlay_versions", versions)
+    main.swap_suggest_index(build_suggest_index([], {}, 100))
+    assert overlay == {("product", 2): None}
+    assert versions == {("product", 2): 110}